@@ -0,0 +1,319 @@
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from ecdsa import SigningKey, SECP256k1
+
+import blockchain as bc
+
+# Synthetic transactions are stamped from a fixed time so runs with the same seed build identical payloads
+EPOCH = 1700000000
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize(samples, items=None):
+    # samples are per-operation latencies in seconds; items counts the work units they covered
+    total = sum(samples)
+    items = items if items is not None else len(samples)
+    return {
+        'operations': len(samples),
+        'items': items,
+        'total_seconds': round(total, 6),
+        'throughput_per_second': round(items / total, 2) if total > 0 else None,
+        'p50_ms': round(percentile(samples, 50) * 1000, 4),
+        'p99_ms': round(percentile(samples, 99) * 1000, 4)
+    }
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+@contextlib.contextmanager
+def quiet():
+    # Keep the node's per-transaction logging out of the measurements
+    level = bc.logger.level
+    bc.logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        bc.logger.setLevel(level)
+
+def reset_caches():
+    bc.signature_cache = bc.SignatureCache()
+    bc.validated_blocks = bc.SignatureCache(bc.VALIDATED_BLOCK_CACHE_SIZE)
+    bc.load_verifying_key.cache_clear()
+
+def make_wallets(count):
+    # Keys come from the seeded generator rather than os.urandom
+    return [bc.Wallet(SigningKey.from_secret_exponent(random.randrange(1, SECP256k1.order), curve=SECP256k1))
+            for _ in range(count)]
+
+def make_transactions(wallets, count, start_index=0):
+    transactions = []
+    samples = []
+    for i in range(start_index, start_index + count):
+        sender = wallets[i % len(wallets)]
+        recipient = wallets[(i + 1) % len(wallets)]
+        start = time.perf_counter()
+        tx = bc.Transaction(sender.get_public_key(), recipient.get_public_key(), 1, timestamp=EPOCH + i)
+        tx.signature = sender.sign_transaction(tx.signing_message())
+        samples.append(time.perf_counter() - start)
+        transactions.append(tx)
+    return transactions, samples
+
+def make_chain(wallets, transactions, txs_per_block):
+    # Reward-only blocks fund every wallet first so the following blocks pass the balance checks;
+    # blocks are stamped exactly TARGET_BLOCK_SECONDS apart so the chain never retargets away from the minimum
+    spend = math.ceil(sum(tx.cost() for tx in transactions) / len(wallets))
+    funding = [([], w.get_public_key()) for w in wallets for _ in range(math.ceil(spend / bc.BLOCK_REWARD))]
+    transfers = [(transactions[i:i + txs_per_block], 'benchmark-miner') for i in range(0, len(transactions), txs_per_block)]
+    blocks = []
+    previous = bc.Blockchain().chain[0]
+    for index, (batch, miner) in enumerate(funding + transfers, start=1):
+        timestamp = previous.timestamp + bc.TARGET_BLOCK_SECONDS
+        reward = bc.Transaction("Network", miner, bc.BLOCK_REWARD + sum(tx.fee for tx in batch), timestamp=timestamp)
+        block = bc.Block(index, previous.hash, batch + [reward], timestamp=timestamp)
+        block.mine_block(workers=1)
+        blocks.append(block)
+        previous = block
+    return blocks
+
+def bench_mining(blocks, difficulty, workers):
+    samples = []
+    hashes = 0
+    for block in blocks:
+        candidate = bc.Block(block.index, block.previous_hash, block.transactions, timestamp=block.timestamp)
+        stats = candidate.mine_block(difficulty=difficulty, workers=workers)
+        samples.append(stats['seconds'])
+        hashes += stats['hashes']
+    result = summarize(samples, hashes)
+    result['difficulty'] = difficulty
+    result['workers'] = workers
+    return result
+
+def bench_verification(transactions, batch_size):
+    reset_caches()
+    serial = [timed(tx.is_valid)[0] for tx in transactions]
+
+    reset_caches()
+    batches = [transactions[i:i + batch_size] for i in range(0, len(transactions), batch_size)]
+    batched = [timed(bc.verify_transactions, batch)[0] for batch in batches]
+
+    cached = [timed(bc.verify_transactions, batch)[0] for batch in batches]
+    return {
+        'serial': summarize(serial),
+        'batched': summarize(batched, len(transactions)),
+        'cached': summarize(cached, len(transactions))
+    }
+
+def bench_merkle(blocks):
+    full = []
+    incremental = []
+    for block in blocks:
+        # Fresh transaction objects so the per-transaction digest cache starts cold
+        transactions = [bc.Transaction.from_dict(tx.to_dict(include_signature=True)) for tx in block.transactions]
+        full.append(timed(bc.calculate_merkle_root, transactions)[0])
+        tree = bc.MerkleTree()
+        for tx in transactions:
+            incremental.append(timed(tree.append, tx.digest())[0])
+    return {'full_build': summarize(full), 'incremental_append': summarize(incremental)}
+
+def bench_add_block(blocks):
+    node = bc.Blockchain()
+    samples = []
+    with quiet():
+        for block in blocks:
+            elapsed, ok = timed(node.add_block, block)
+            if not ok:
+                raise RuntimeError(f"Synthetic block {block.index} was rejected")
+            samples.append(elapsed)
+    return summarize(samples, sum(len(b.transactions) for b in blocks)), node
+
+class TestClientAdapter(requests.adapters.BaseAdapter):
+    # Answers a node's peer requests from the Flask app in-process, so the sync stage runs the
+    # node's real client code (sessions, stats, streaming) without sockets
+    def __init__(self, app):
+        super().__init__()
+        self.client = app.test_client()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urllib.parse.urlsplit(request.url)
+        result = self.client.open(url.path, method=request.method, query_string=url.query,
+                                  headers=dict(request.headers), data=request.body)
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(result.headers)
+        response._content = result.get_data()
+        response.raw = io.BytesIO(response._content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+def bench_sync_replay(source, blocks):
+    # A fresh node syncs from `source` through resolve_conflicts, with caches cold: chain location,
+    # headers-first download, then streamed blocks checked and connected batch by batch
+    bc.blockchain = source
+    peer = 'benchmark-peer:5000'
+    node = bc.Blockchain()
+    node.nodes.add(peer)
+    node.peers._session(peer).mount('http://', TestClientAdapter(bc.app))
+    reset_caches()
+
+    headers, branch = [], []
+    fetch_headers, extend_chain = node._fetch_headers, node._extend_chain
+
+    def timed_headers(*args):
+        elapsed, result = timed(fetch_headers, *args)
+        headers.append(elapsed)
+        return result
+
+    def timed_extend(*args):
+        elapsed, result = timed(extend_chain, *args)
+        branch.append(elapsed)
+        return result
+
+    node._fetch_headers, node._extend_chain = timed_headers, timed_extend
+    with quiet():
+        elapsed, replaced = timed(node.resolve_conflicts)
+    if not replaced or node.chain[-1].hash != blocks[-1].hash:
+        raise RuntimeError("Sync did not reach the source node's tip")
+    transactions = sum(len(b.transactions) for b in blocks)
+    return {
+        'headers': summarize(headers, len(blocks)),
+        'blocks': summarize(branch, transactions),
+        'total': summarize([elapsed], transactions)
+    }
+
+def bench_endpoints(node, wallets, transactions, clients, requests_per_client):
+    bc.blockchain = node
+    addresses = [w.get_public_key() for w in wallets]
+    fresh = iter(transactions)
+
+    def balance(client):
+        return client.get('/wallet/balance', query_string={'public_key': random.choice(addresses)})
+
+    def chain_page(client):
+        return client.get('/chain', query_string={'from_height': max(0, len(node.chain) - 10), 'limit': 10})
+
+    def receive(client):
+        tx = next(fresh, None)
+        if tx is None:
+            return balance(client)
+        return client.post('/transactions/receive', data=tx.to_bytes(), content_type=bc.BINARY_MIMETYPE)
+
+    routes = {'wallet_balance': balance, 'chain_page': chain_page, 'transactions_receive': receive}
+
+    def worker(name):
+        client = bc.app.test_client()
+        samples = []
+        for _ in range(requests_per_client):
+            elapsed, response = timed(routes[name], client)
+            response.get_data()
+            samples.append(elapsed)
+        return samples
+
+    results = {}
+    with quiet(), ThreadPoolExecutor(max_workers=clients) as pool:
+        for name in routes:
+            start = time.perf_counter()
+            samples = [s for batch in pool.map(worker, [name] * clients) for s in batch]
+            wall = time.perf_counter() - start
+            results[name] = summarize(samples)
+            results[name]['requests_per_second'] = round(len(samples) / wall, 2)
+            results[name]['clients'] = clients
+    return results
+
+def run(args):
+    random.seed(args.seed)
+    stages = {}
+
+    wallets = make_wallets(args.wallets)
+    transactions, signing = make_transactions(wallets, args.transactions)
+    stages['signing'] = summarize(signing)
+
+    blocks = make_chain(wallets, transactions, args.txs_per_block)
+    stages['mining'] = bench_mining(blocks[:args.mining_blocks], args.difficulty, args.workers)
+    stages['verification'] = bench_verification(transactions, args.batch_size)
+    stages['merkle'] = bench_merkle(blocks)
+    stages['add_block'], node = bench_add_block(blocks)
+    stages['sync_replay'] = bench_sync_replay(node, blocks)
+
+    load_transactions, _ = make_transactions(wallets, args.clients * args.requests, start_index=len(transactions))
+    stages['endpoints'] = bench_endpoints(node, wallets, load_transactions, args.clients, args.requests)
+
+    return {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': vars(args)
+        },
+        'stages': stages
+    }
+
+def flatten(stages, prefix=''):
+    for key, value in stages.items():
+        if isinstance(value, dict) and 'throughput_per_second' in value:
+            yield prefix + key, value
+        elif isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+
+def compare(current, baseline):
+    base = dict(flatten(baseline['stages']))
+    print(f"{'stage':40} {'baseline/s':>14} {'current/s':>14} {'change':>8} {'p99 ms':>10}")
+    for name, result in flatten(current['stages']):
+        old = base.get(name)
+        new_rate = result['throughput_per_second']
+        old_rate = old['throughput_per_second'] if old else None
+        change = f"{(new_rate / old_rate - 1) * 100:+.1f}%" if old_rate and new_rate else 'n/a'
+        print(f"{name:40} {old_rate if old_rate is not None else '-':>14} {new_rate:>14} {change:>8} {result['p99_ms']:>10}")
+
+def report(results):
+    print(f"{'stage':40} {'items/s':>14} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, result in flatten(results['stages']):
+        print(f"{name:40} {result['throughput_per_second']:>14} {result['p50_ms']:>10} {result['p99_ms']:>10}")
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark the node hot paths')
+    parser.add_argument('--wallets', default=20, type=int, help='number of synthetic wallets')
+    parser.add_argument('--transactions', default=1000, type=int, help='number of signed transactions to generate')
+    parser.add_argument('--txs-per-block', default=100, type=int, help='transactions per synthetic block')
+    parser.add_argument('--mining-blocks', default=3, type=int, help='number of blocks to mine in the mining stage')
+    parser.add_argument('--difficulty', default=bc.DIFFICULTY, type=int, help='difficulty for the mining stage')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='mining worker processes')
+    parser.add_argument('--batch-size', default=100, type=int, help='transactions per verification batch')
+    parser.add_argument('--clients', default=8, type=int, help='concurrent clients in the endpoint stage')
+    parser.add_argument('--requests', default=50, type=int, help='requests per client and endpoint')
+    parser.add_argument('--seed', default=1, type=int, help='random seed for workload generation')
+    parser.add_argument('--output', default=None, help='write JSON results to this file')
+    parser.add_argument('--compare', default=None, help='baseline JSON results to compare against')
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
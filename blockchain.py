@@ -1,47 +1,421 @@
 import hashlib
 import json
+import math
+import os
 import time
 import random
-from flask import Flask, jsonify, request
+import sys
+import tempfile
+import heapq
+import itertools
+import multiprocessing
+import functools
+import mmap
+import struct
+import queue
+import sqlite3
+import threading
+import contextlib
+import logging
+import logging.handlers
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, g, jsonify, request
 import requests
+from requests.adapters import HTTPAdapter
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
 from typing import List
 
 app = Flask(__name__)
+logger = logging.getLogger('blockchain')
 
-class Wallet:
+def configure_logging(level='INFO'):
+    # Records are queued and written by a background listener, so logging never blocks a request
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_sample(name, key, value):
+    if key:
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in key)
+        name += '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + '}'
+    return f'{name} {value}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, (), self.fn())]
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # label key -> [per-bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    samples.append((self.name + '_bucket', key + (('le', bound),), cumulative))
+                samples.append((self.name + '_bucket', key + (('le', '+Inf'),), count))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, count))
+        return samples
+
+class MetricsRegistry:
     def __init__(self):
-        self.private_key = SigningKey.generate(curve=SECP256k1)
+        self._metrics = OrderedDict()
+
+    def counter(self, name, help):
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn):
+        self._metrics[name] = Gauge(name, help, fn)
+        return self._metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(_format_sample(*sample) for sample in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+MINING_SECONDS = metrics.histogram('excoin_mining_seconds', 'Proof-of-work time per block')
+MINING_HASHES = metrics.counter('excoin_mining_hashes_total', 'Header hashes computed while mining')
+VERIFY_SECONDS = metrics.histogram('excoin_signature_verification_seconds', 'Time to verify one batch of transactions')
+SIGNATURES = metrics.counter('excoin_signatures_total', 'Signature checks by result')
+MERKLE_SECONDS = metrics.histogram('excoin_merkle_root_seconds', 'Time to compute a Merkle root')
+BLOCK_APPLY_SECONDS = metrics.histogram('excoin_block_apply_seconds', 'Time for add_block to validate and apply a block')
+BLOCKS = metrics.counter('excoin_blocks_total', 'Blocks offered to add_block by result')
+PEER_REQUEST_SECONDS = metrics.histogram('excoin_peer_request_seconds', 'Outbound peer request latency')
+PEER_FAILURES = metrics.counter('excoin_peer_request_failures_total', 'Failed outbound peer requests')
+HTTP_REQUEST_SECONDS = metrics.histogram('excoin_http_request_seconds', 'HTTP handler latency until the first byte')
+
+class Wallet:
+    def __init__(self, private_key=None):
+        self.private_key = private_key or SigningKey.generate(curve=SECP256k1)
         self.public_key = self.private_key.get_verifying_key()
 
     def sign_transaction(self, transaction_data):
-        return self.private_key.sign(transaction_data.encode()).hex()
+        # RFC 6979 nonces: the same key and message always give the same signature
+        return self.private_key.sign_deterministic(transaction_data.encode()).hex()
 
     def get_public_key(self):
         return self.public_key.to_string().hex()
 
+PUBLIC_KEY_CACHE_SIZE = 4096
+SIGNATURE_CACHE_SIZE = 100000
+PARALLEL_VERIFY_THRESHOLD = 16
+
+@functools.lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def load_verifying_key(public_key_hex):
+    return VerifyingKey.from_string(bytes.fromhex(public_key_hex), curve=SECP256k1)
+
 def verify_signature(public_key_hex, message, signature):
-    public_key = VerifyingKey.from_string(bytes.fromhex(public_key_hex), curve=SECP256k1)
     try:
+        public_key = load_verifying_key(public_key_hex)
         return public_key.verify(bytes.fromhex(signature), message.encode())
     except:
         return False
 
+class SignatureCache:
+    def __init__(self, max_size=SIGNATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(transaction_id, digest, signature):
+        # The signed payload digest is part of the key so a reused id with altered fields never hits
+        return (transaction_id, signature, digest)
+
+    def __contains__(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key):
+        self._entries[key] = True
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+signature_cache = SignatureCache()
+_verify_pool = None
+
+def _verify_job(job):
+    return verify_signature(*job)
+
+def _get_verify_pool():
+    global _verify_pool
+    if _verify_pool is None:
+        _verify_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _verify_pool
+
+def verify_transactions(transactions):
+    with VERIFY_SECONDS.time():
+        return _verify_transactions(transactions)
+
+def _verify_transactions(transactions):
+    results = [False] * len(transactions)
+    pending = []
+    for i, tx in enumerate(transactions):
+        if tx.sender == "Network":
+            results[i] = True
+        elif tx.signature and tx.sender:
+            key = SignatureCache.key(tx.transaction_id, tx.digest(), tx.signature)
+            if key in signature_cache:
+                results[i] = True
+                SIGNATURES.inc(result='cached')
+            else:
+                pending.append((i, key, (tx.sender, tx.signing_message(), tx.signature)))
+
+    jobs = [job for _, _, job in pending]
+    if len(jobs) >= PARALLEL_VERIFY_THRESHOLD and (os.cpu_count() or 1) > 1:
+        chunksize = max(1, len(jobs) // (4 * os.cpu_count()))
+        verified = list(_get_verify_pool().map(_verify_job, jobs, chunksize=chunksize))
+    else:
+        verified = [_verify_job(job) for job in jobs]
+
+    for (i, key, _), ok in zip(pending, verified):
+        if ok:
+            signature_cache.add(key)
+        results[i] = ok
+        SIGNATURES.inc(result='valid' if ok else 'invalid')
+    return results
+
+BINARY_VERSION = 1
+BINARY_MIMETYPE = 'application/x-excoin'
+FRAME_PREFIX = struct.Struct('>I')
+_TAG_NONE, _TAG_HEX, _TAG_STR, _TAG_INT, _TAG_FLOAT, _TAG_BIGINT = range(6)
+
+def _pack_value(out: bytearray, value):
+    # Hex strings (keys, hashes, signatures) are stored as raw bytes; other values keep their JSON type
+    if value is None:
+        out.append(_TAG_NONE)
+    elif isinstance(value, str):
+        raw = None
+        if len(value) % 2 == 0 and len(value) // 2 <= 255:
+            try:
+                raw = bytes.fromhex(value)
+            except ValueError:
+                pass
+        if raw is not None and raw.hex() == value:
+            out.append(_TAG_HEX)
+            out.append(len(raw))
+            out += raw
+        else:
+            encoded = value.encode()
+            out.append(_TAG_STR)
+            out += struct.pack('>H', len(encoded))
+            out += encoded
+    elif isinstance(value, float):
+        out.append(_TAG_FLOAT)
+        out += struct.pack('>d', value)
+    elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        out.append(_TAG_INT)
+        out += struct.pack('>q', value)
+    elif isinstance(value, int):
+        encoded = str(value).encode()
+        out.append(_TAG_BIGINT)
+        out.append(len(encoded))
+        out += encoded
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} in binary format")
+
+def _unpack_value(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == _TAG_NONE:
+        return None, offset
+    if tag == _TAG_HEX:
+        length = data[offset]
+        return bytes(data[offset + 1:offset + 1 + length]).hex(), offset + 1 + length
+    if tag == _TAG_STR:
+        (length,) = struct.unpack_from('>H', data, offset)
+        return bytes(data[offset + 2:offset + 2 + length]).decode(), offset + 2 + length
+    if tag == _TAG_INT:
+        return struct.unpack_from('>q', data, offset)[0], offset + 8
+    if tag == _TAG_FLOAT:
+        return struct.unpack_from('>d', data, offset)[0], offset + 8
+    if tag == _TAG_BIGINT:
+        length = data[offset]
+        return int(bytes(data[offset + 1:offset + 1 + length])), offset + 1 + length
+    raise ValueError(f"Unknown binary field tag {tag}")
+
+def _pack_fields(d: dict, fields):
+    out = bytearray([BINARY_VERSION])
+    for field in fields:
+        _pack_value(out, d.get(field))
+    return out
+
+def _unpack_fields(data, fields, offset=0):
+    if data[offset] != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary version {data[offset]}")
+    offset += 1
+    d = {}
+    for field in fields:
+        # Fields added later go at the end, so payloads from before them simply stop early
+        if offset >= len(data):
+            d[field] = None
+            continue
+        d[field], offset = _unpack_value(data, offset)
+    return d, offset
+
+def pack_frames(payloads):
+    return b''.join(FRAME_PREFIX.pack(len(p)) + p for p in payloads)
+
+def unpack_frames(data):
+    offset = 0
+    while offset < len(data):
+        (length,) = FRAME_PREFIX.unpack_from(data, offset)
+        offset += FRAME_PREFIX.size
+        yield data[offset:offset + length]
+        offset += length
+
+def read_frames(stream):
+    while True:
+        head = stream.read(FRAME_PREFIX.size)
+        if not head:
+            return
+        (length,) = FRAME_PREFIX.unpack(head)
+        yield stream.read(length)
+
+def _intern(value):
+    # Addresses repeat across many transactions; one shared string per address instead of a copy each
+    return sys.intern(value) if isinstance(value, str) else value
+
+def is_number(value):
+    # Amounts and fees arrive as decoded JSON; bools, strings and non-finite floats are not amounts
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or isinstance(value, float) and math.isfinite(value)
+
+def _is_integer(value):
+    # Heights and chain work from peers: any size of int, but not a bool or a float
+    return isinstance(value, int) and not isinstance(value, bool)
+
 class Transaction:
-    def __init__(self, sender, recipient, amount, signature=None, timestamp=None, nonce=None, transaction_id=None, chain_id="excoin"):
-        self.sender = sender
-        self.recipient = recipient
+    __slots__ = ('sender', 'recipient', 'amount', 'fee', 'signature', 'timestamp', 'nonce', 'transaction_id', 'chain_id',
+                 '_message', '_digest', '_size')
+
+    def __init__(self, sender, recipient, amount, signature=None, timestamp=None, nonce=None, transaction_id=None, chain_id="excoin", fee=0):
+        self.sender = _intern(sender)
+        self.recipient = _intern(recipient)
         self.amount = amount
+        self.fee = fee or 0
         self.signature = signature
         self.timestamp = timestamp or int(time.time())
         self.nonce = nonce or random.randint(1, 1000000)
         self.transaction_id = transaction_id or self.generate_transaction_id()
-        self.chain_id = chain_id
+        self.chain_id = _intern(chain_id)
+        # Transactions are treated as immutable once built, so the signed payload and its hash are cached
+        self._message = None
+        self._digest = None
+        self._size = None
 
     def generate_transaction_id(self):
         transaction_data = f"{self.sender}{self.recipient}{self.amount}{self.timestamp}{self.nonce}"
+        if self.fee:
+            transaction_data += f"{self.fee}"
         return hashlib.sha256(transaction_data.encode()).hexdigest()
 
+    def has_valid_fee(self):
+        return is_number(self.fee) and self.fee >= 0
+
+    def has_valid_amount(self):
+        return is_number(self.amount) and self.amount > 0
+
+    def cost(self):
+        # What the sender's balance is charged: the amount plus the fee paid to the miner
+        return self.amount + self.fee
+
+    def size(self):
+        if self._size is None:
+            try:
+                size = len(self.to_bytes())
+            except (TypeError, ValueError, OverflowError, struct.error):
+                # A field the binary codec cannot hold; such a transaction never fits in a block
+                return math.inf
+            if self.signature is None:
+                return size
+            self._size = size
+        return self._size
+
+    def fee_rate(self):
+        return self.fee / self.size()
+
     def to_dict(self, include_signature=False):
         base = {
             'sender': self.sender,
@@ -52,6 +426,9 @@ class Transaction:
             'transaction_id': self.transaction_id,
             'chain_id': self.chain_id
         }
+        # Fee-less transactions keep the original payload so their ids and signatures are unchanged
+        if self.fee:
+            base['fee'] = self.fee
         if include_signature:
             base['signature'] = self.signature
         return base
@@ -66,45 +443,287 @@ class Transaction:
             timestamp=d.get('timestamp'),
             nonce=d.get('nonce'),
             transaction_id=d.get('transaction_id'),
-            chain_id=d.get('chain_id', 'excoin')
+            chain_id=d.get('chain_id', 'excoin'),
+            fee=d.get('fee', 0)
         )
 
+    BINARY_FIELDS = ('sender', 'recipient', 'amount', 'timestamp', 'nonce', 'transaction_id', 'chain_id', 'signature', 'fee')
+
+    def to_bytes(self):
+        fields = self.BINARY_FIELDS if self.fee else self.BINARY_FIELDS[:-1]
+        return bytes(_pack_fields(self.to_dict(include_signature=True), fields))
+
+    @classmethod
+    def from_bytes(cls, data):
+        d, _ = _unpack_fields(data, cls.BINARY_FIELDS)
+        return cls.from_dict(d)
+
+    def signing_message(self):
+        if self._message is None:
+            self._message = json.dumps(self.to_dict(), sort_keys=True)
+        return self._message
+
+    def digest(self):
+        # Merkle leaf: sha256 of the canonical unsigned payload
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.signing_message().encode()).digest()
+        return self._digest
+
     def is_valid(self):
-        if self.sender == "Network":  # Mining reward doesn't need signature validation
-            return True
-        if not self.signature or not self.sender:
+        return verify_transactions([self])[0]
+
+MAX_FIELD_CHARS = 512
+
+def _well_formed(transaction: Transaction, unsigned=False):
+    # Field types and sizes a client or peer can get wrong, so everything admitted can be
+    # hashed, encoded and ranked; signs, balances and signatures are checked at admission.
+    # Reward transactions carry no signature, so callers handling them pass unsigned=True
+    fields = ('sender', 'recipient', 'transaction_id', 'chain_id')
+    if not (unsigned and transaction.signature is None):
+        fields += ('signature',)
+    return (all(isinstance(getattr(transaction, field), str) and len(getattr(transaction, field)) <= MAX_FIELD_CHARS
+                for field in fields)
+            and all(is_number(value) and -2 ** 63 <= value < 2 ** 63
+                    for value in (transaction.amount, transaction.fee, transaction.timestamp))
+            and _is_integer(transaction.nonce) and -2 ** 63 <= transaction.nonce < 2 ** 63)
+
+def _merkle_parent(left, right):
+    # Nodes are kept as raw digests but combined as hex text, matching the roots already on chain
+    return hashlib.sha256(left.hex().encode() + right.hex().encode()).digest()
+
+class MerkleTree:
+    def __init__(self, leaves=()):
+        self.levels = [list(leaves)]
+        level = self.levels[0]
+        while len(level) > 1:
+            level = [_merkle_parent(level[i], level[i + 1] if i + 1 < len(level) else level[i])
+                     for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    @classmethod
+    def from_transactions(cls, transactions: List[Transaction]):
+        return cls(tx.digest() for tx in transactions)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def copy(self):
+        tree = MerkleTree()
+        tree.levels = [list(level) for level in self.levels]
+        return tree
+
+    def append(self, leaf):
+        # Only the path from the new leaf to the root is recomputed
+        self.levels[0].append(leaf)
+        index = len(self.levels[0]) - 1
+        depth = 0
+        while len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            parent = index // 2
+            left = level[2 * parent]
+            right = level[2 * parent + 1] if 2 * parent + 1 < len(level) else left
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            above = self.levels[depth + 1]
+            if parent < len(above):
+                above[parent] = _merkle_parent(left, right)
+            else:
+                above.append(_merkle_parent(left, right))
+            index = parent
+            depth += 1
+
+    def root(self):
+        return self.levels[-1][0].hex() if self.levels[0] else ''
+
+    def proof(self, index):
+        path = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling >= len(level):
+                sibling = index
+            path.append({'hash': level[sibling].hex(), 'position': 'right' if index % 2 == 0 else 'left'})
+            index //= 2
+        return path
+
+    @staticmethod
+    def verify_proof(leaf_hex, proof, root_hex):
+        try:
+            node = bytes.fromhex(leaf_hex)
+            for step in proof:
+                sibling = bytes.fromhex(step['hash'])
+                node = _merkle_parent(node, sibling) if step['position'] == 'right' else _merkle_parent(sibling, node)
+        except (ValueError, KeyError, TypeError):
             return False
-        transaction_data = json.dumps(self.to_dict(), sort_keys=True)
-        return verify_signature(self.sender, transaction_data, self.signature)
+        return node.hex() == root_hex
 
 def calculate_merkle_root(transactions: List[Transaction]) -> str:
-    if not transactions:
-        return ''
-    
-    transaction_hashes = [hashlib.sha256(json.dumps(tx.to_dict(), sort_keys=True).encode()).hexdigest() for tx in transactions]
+    with MERKLE_SECONDS.time():
+        return MerkleTree.from_transactions(transactions).root()
 
-    while len(transaction_hashes) > 1:
-        if len(transaction_hashes) % 2 == 1:
-            transaction_hashes.append(transaction_hashes[-1])
-        
-        new_hashes = []
-        for i in range(0, len(transaction_hashes), 2):
-            combined_hash = hashlib.sha256((transaction_hashes[i] + transaction_hashes[i + 1]).encode()).hexdigest()
-            new_hashes.append(combined_hash)
-        transaction_hashes = new_hashes
+DIFFICULTY = 4
+TARGET_BLOCK_SECONDS = 10
+RETARGET_INTERVAL = 10
+MAX_RETARGET_FACTOR = 4
+MAX_FUTURE_BLOCK_SECONDS = 2 * 60 * 60
+MEDIAN_TIME_SPAN = 11
+
+def difficulty_to_target(difficulty):
+    # Difficulty d is the old "d leading hex zeros" rule: any hash below 16^(64-d) qualifies
+    return 16 ** (64 - difficulty)
+
+def target_to_difficulty(target):
+    return 64 - math.log(target, 16)
+
+def expected_hashes(target):
+    # Integer so chain work adds up exactly on every node
+    return 2 ** 256 // target
+
+# The easiest target allowed; the genesis block and every chain start here
+MAX_TARGET = difficulty_to_target(DIFFICULTY)
+
+def retarget(target, first, last):
+    # Scale the target by how long the last epoch took against how long it should have taken.
+    # Integer maths on millisecond timespans keeps every node's result identical
+    expected = TARGET_BLOCK_SECONDS * (RETARGET_INTERVAL - 1) * 1000
+    actual = int(round((last.timestamp - first.timestamp) * 1000))
+    actual = min(max(actual, expected // MAX_RETARGET_FACTOR), expected * MAX_RETARGET_FACTOR)
+    return min(target * actual // expected, MAX_TARGET)
+
+class TargetSchedule:
+    # Proof-of-work target per epoch of RETARGET_INTERVAL blocks, derived from block timestamps;
+    # block_at(height) supplies blocks so a candidate branch can be scheduled as well as our chain
+    def __init__(self, block_at, targets=None, work=None):
+        self.block_at = block_at
+        self.targets = list(targets) if targets else [MAX_TARGET]
+        # Cumulative work of the first n complete epochs
+        self.work = list(work[:len(self.targets) + 1]) if work else [0]
+
+    def target_for(self, height):
+        epoch = height // RETARGET_INTERVAL
+        while len(self.targets) <= epoch:
+            start = len(self.targets) * RETARGET_INTERVAL
+            first = self.block_at(start - RETARGET_INTERVAL)
+            last = self.block_at(start - 1)
+            self.targets.append(retarget(self.targets[-1], first, last))
+        return self.targets[epoch]
+
+    def chain_work(self, length):
+        # Expected hashes to build the first `length` blocks; the target is fixed within an epoch
+        epochs, partial = divmod(length, RETARGET_INTERVAL)
+        self.target_for(epochs * RETARGET_INTERVAL)
+        while len(self.work) <= epochs:
+            self.work.append(self.work[-1] + RETARGET_INTERVAL * expected_hashes(self.targets[len(self.work) - 1]))
+        return self.work[epochs] + partial * expected_hashes(self.targets[epochs])
 
-    return transaction_hashes[0]
+    def median_time_past(self, height):
+        # A block must be stamped later than the median of the blocks before it, so timestamps
+        # cannot be walked backwards to keep the target easy
+        times = sorted(self.block_at(h).timestamp for h in range(max(0, height - MEDIAN_TIME_SPAN), height))
+        return times[len(times) // 2]
+
+    def prefix(self, length):
+        # Epoch targets that only depend on the first `length` blocks
+        return self.targets[:length // RETARGET_INTERVAL + 1]
+
+    def to_dict(self, length):
+        # What the first `length` blocks fix, for state.json; lists of ints of any size
+        self.chain_work(length)
+        targets = self.prefix(length)
+        return {'targets': targets, 'work': self.work[:len(targets) + 1]}
+
+    @staticmethod
+    def valid_state(targets, work):
+        # Checks a schedule read back from state.json before it is trusted
+        return (isinstance(targets, list) and isinstance(work, list) and targets and work and len(work) <= len(targets) + 1
+                and targets[0] == MAX_TARGET and work[0] == 0
+                and all(_is_integer(target) and 0 < target <= MAX_TARGET for target in targets)
+                and all(work[epoch + 1] == work[epoch] + RETARGET_INTERVAL * expected_hashes(targets[epoch])
+                        for epoch in range(len(work) - 1)))
+
+    def truncate(self, length):
+        del self.targets[length // RETARGET_INTERVAL + 1:]
+        del self.work[len(self.targets) + 1:]
 
 class Block:
-    def __init__(self, index, previous_hash, transactions, nonce=0, hash=None):
+    __slots__ = ('index', 'timestamp', 'previous_hash', 'transactions', 'merkle_root', 'nonce', 'hash')
+
+    def __init__(self, index, previous_hash, transactions, nonce=0, hash=None, timestamp=None, merkle_root=None):
         self.index = index
-        self.timestamp = time.time()
+        self.timestamp = timestamp if timestamp is not None else time.time()
         self.previous_hash = previous_hash
         self.transactions = transactions
-        self.merkle_root = calculate_merkle_root(transactions)
+        self.merkle_root = merkle_root if merkle_root is not None else calculate_merkle_root(transactions)
         self.nonce = nonce
         self.hash = hash
 
+    def header_dict(self):
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'current_hash': self.hash,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+            'nonce': self.nonce
+        }
+
+    def to_dict(self):
+        d = self.header_dict()
+        d['transactions'] = [tx.to_dict(include_signature=True) for tx in self.transactions]
+        return d
+
+    def merkle_proof(self, transaction_id):
+        for index, tx in enumerate(self.transactions):
+            if tx.transaction_id == transaction_id:
+                return index, MerkleTree.from_transactions(self.transactions).proof(index)
+        return None, None
+
+    HEADER_FIELDS = ('index', 'timestamp', 'current_hash', 'previous_hash', 'merkle_root', 'nonce')
+
+    def to_bytes(self):
+        out = _pack_fields(self.header_dict(), self.HEADER_FIELDS)
+        out += FRAME_PREFIX.pack(len(self.transactions))
+        out += pack_frames(tx.to_bytes() for tx in self.transactions)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data, trust_merkle_root=False):
+        d, offset = _unpack_fields(data, cls.HEADER_FIELDS)
+        (count,) = FRAME_PREFIX.unpack_from(data, offset)
+        offset += FRAME_PREFIX.size
+        transactions = []
+        for payload in unpack_frames(memoryview(data)[offset:]):
+            transactions.append(Transaction.from_bytes(payload))
+        if len(transactions) != count:
+            raise ValueError("Truncated block payload")
+        return cls(
+            index=d['index'],
+            previous_hash=d['previous_hash'],
+            transactions=transactions,
+            nonce=d['nonce'],
+            hash=d['current_hash'],
+            timestamp=d['timestamp'],
+            merkle_root=d['merkle_root'] if trust_merkle_root else None
+        )
+
+    def meets_target(self, target):
+        # The header hash, read as a 256-bit number, must be below the target
+        return self.hash == self.calculate_hash() and int(self.hash, 16) < target
+
+    def has_valid_proof(self, difficulty=DIFFICULTY):
+        return self.meets_target(difficulty_to_target(difficulty))
+
+    @classmethod
+    def from_dict(cls, d: dict, trust_merkle_root=False):
+        return cls(
+            index=d['index'],
+            previous_hash=d['previous_hash'],
+            transactions=[Transaction.from_dict(tx) for tx in d.get('transactions', [])],
+            nonce=d['nonce'],
+            hash=d['current_hash'],
+            timestamp=d.get('timestamp'),
+            merkle_root=d.get('merkle_root') if trust_merkle_root else None
+        )
+
     def calculate_hash(self):
         block_data = json.dumps({
             'index': self.index,
@@ -115,38 +734,1102 @@ class Block:
         }, sort_keys=True)
         return hashlib.sha256(block_data.encode()).hexdigest()
 
-    def mine_block(self, difficulty=4):
-        target = '0' * difficulty
-        while self.hash is None or self.hash[:difficulty] != target:
-            self.nonce += 1
-            self.hash = self.calculate_hash()
+    def header_template(self):
+        # Split the serialized header around the nonce so miners only hash the changing bytes
+        block_data = json.dumps({
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+            'nonce': _NONCE_MARKER
+        }, sort_keys=True)
+        prefix, suffix = block_data.split(json.dumps(_NONCE_MARKER))
+        return prefix.encode(), suffix.encode()
 
-class Blockchain:
+    def mine_block(self, difficulty=DIFFICULTY, workers=None, target=None):
+        target = difficulty_to_target(difficulty) if target is None else target
+        stats = {'difficulty': round(target_to_difficulty(target), 4), 'expected_hashes': round(expected_hashes(target))}
+        if self.hash is not None and self.meets_target(target):
+            return {'hashes': 0, 'seconds': 0.0, 'hashrate': 0.0, **stats}
+
+        prefix, suffix = self.header_template()
+        workers = workers or os.cpu_count() or 1
+        # Big-endian digests compare as bytes exactly as the numbers they encode
+        target_bytes = min(target, 2 ** 256 - 1).to_bytes(32, 'big')
+        start = time.perf_counter()
+        if workers == 1:
+            nonce, block_hash, hashes = _search_nonces(prefix, suffix, target_bytes, self.nonce + 1, 1)
+        else:
+            nonce, block_hash, hashes = _parallel_search(prefix, suffix, target_bytes, self.nonce + 1, workers)
+        elapsed = time.perf_counter() - start
+        MINING_SECONDS.observe(elapsed)
+        MINING_HASHES.inc(hashes)
+
+        self.nonce = nonce
+        self.hash = block_hash
+        return {
+            'hashes': hashes,
+            'seconds': elapsed,
+            'hashrate': hashes / elapsed if elapsed > 0 else 0.0,
+            **stats
+        }
+
+_NONCE_MARKER = '__nonce__'
+POW_BATCH_SIZE = 10000
+
+def _search_nonces(prefix, suffix, target, nonce, step, stop_event=None):
+    base = hashlib.sha256(prefix)
+    hashes = 0
+    while stop_event is None or not stop_event.is_set():
+        for _ in range(POW_BATCH_SIZE):
+            h = base.copy()
+            h.update(b'%d' % nonce + suffix)
+            hashes += 1
+            if h.digest() < target:
+                return nonce, h.hexdigest(), hashes
+            nonce += step
+    return None, None, hashes
+
+_pow_pool = None
+_pow_pool_lock = threading.Lock()
+# Set by whichever worker finds a hash first; inherited by the pool's processes when they start
+_pow_stop = None
+
+def _init_pow_worker(stop_event):
+    global _pow_stop
+    _pow_stop = stop_event
+
+def _pow_worker(prefix, suffix, target, nonce, step):
+    found_nonce, digest, hashes = _search_nonces(prefix, suffix, target, nonce, step, _pow_stop)
+    if found_nonce is not None:
+        _pow_stop.set()
+    return found_nonce, digest, hashes
+
+def _get_pow_pool(workers):
+    # Long-lived like the verification pool, so a block costs a few task submissions rather than
+    # starting a process per core; rebuilt only when the worker count changes
+    global _pow_pool, _pow_stop
+    if _pow_pool is None or _pow_pool._max_workers != workers:
+        if _pow_pool is not None:
+            _pow_pool.shutdown()
+        _pow_stop = multiprocessing.Event()
+        _pow_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_pow_worker, initargs=(_pow_stop,))
+    return _pow_pool
+
+def _parallel_search(prefix, suffix, target, nonce, workers):
+    # Worker i tries nonce + i, nonce + i + workers, ... until any worker finds a valid hash.
+    # The pool's stop event is shared, so searches run one at a time
+    global _pow_pool
+    with _pow_pool_lock:
+        pool = _get_pow_pool(workers)
+        _pow_stop.clear()
+        try:
+            futures = [pool.submit(_pow_worker, prefix, suffix, target, nonce + i, workers) for i in range(workers)]
+            outcomes = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool on the next search
+            _pow_pool = None
+            raise
+    found = None
+    total_hashes = 0
+    for found_nonce, digest, hashes in outcomes:
+        total_hashes += hashes
+        if found_nonce is not None and (found is None or found_nonce < found[0]):
+            found = (found_nonce, digest)
+    return found[0], found[1], total_hashes
+
+MEMPOOL_MAX_SIZE = 10000
+TRANSACTION_BATCH_MAX = 5000
+
+class Mempool:
+    def __init__(self, max_size=MEMPOOL_MAX_SIZE):
+        self.max_size = max_size
+        self._by_id = {}
+        self._by_sender = {}
+        # sender -> total amount committed by its pending transactions
+        self._spending = {}
+        self._seq = {}
+        # Heap with lazy deletion, worst entry first, for eviction when the pool is full
+        self._worst = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._by_id
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def get(self, transaction_id):
+        return self._by_id.get(transaction_id)
+
+    def spending(self, sender):
+        return self._spending.get(sender, 0)
+
+    def priority(self, transaction: Transaction, seq):
+        # Higher tuples are mined first: best fee rate, then older transactions
+        return (transaction.fee_rate(), -seq)
+
+    def add(self, transaction: Transaction):
+        if transaction.transaction_id in self._by_id:
+            return False
+        seq = next(self._counter)
+        score = self.priority(transaction, seq)
+        if len(self._by_id) >= self.max_size:
+            worst = self._peek(self._worst)
+            if worst is None or worst[0] >= score:
+                return False
+            self.remove(worst[-1])
+
+        self._by_id[transaction.transaction_id] = transaction
+        self._by_sender.setdefault(transaction.sender, {})[transaction.transaction_id] = transaction
+        self._spending[transaction.sender] = self._spending.get(transaction.sender, 0) + transaction.cost()
+        self._seq[transaction.transaction_id] = seq
+        heapq.heappush(self._worst, (score, seq, transaction.transaction_id))
+        return True
+
+    def remove(self, transaction_id):
+        transaction = self._by_id.pop(transaction_id, None)
+        if transaction is None:
+            return None
+        del self._seq[transaction_id]
+        queue = self._by_sender[transaction.sender]
+        del queue[transaction_id]
+        if not queue:
+            del self._by_sender[transaction.sender]
+            del self._spending[transaction.sender]
+        else:
+            self._spending[transaction.sender] -= transaction.cost()
+        self._compact()
+        return transaction
+
+    def remove_many(self, transaction_ids):
+        removed = []
+        for transaction_id in transaction_ids:
+            transaction = self.remove(transaction_id)
+            if transaction is not None:
+                removed.append(transaction)
+        return removed
+
+    def by_sender(self, sender):
+        return list(self._by_sender.get(sender, {}).values())
+
+    def pending_count(self, sender):
+        return len(self._by_sender.get(sender, ()))
+
+    def ordered(self):
+        # Best priority first, but never ahead of an earlier transaction from the same sender:
+        # only the oldest remaining transaction of each sender competes at any time
+        queues = {sender: iter(list(txs.values())) for sender, txs in self._by_sender.items()}
+        heads = []
+        for sender, queue in queues.items():
+            tx = next(queue)
+            seq = self._seq[tx.transaction_id]
+            heads.append((tuple(-x for x in self.priority(tx, seq)), seq, sender, tx))
+        heapq.heapify(heads)
+        while heads:
+            _, _, sender, tx = heapq.heappop(heads)
+            yield tx
+            tx = next(queues[sender], None)
+            if tx is not None:
+                seq = self._seq[tx.transaction_id]
+                heapq.heappush(heads, (tuple(-x for x in self.priority(tx, seq)), seq, sender, tx))
+
+    def select(self, limit=None):
+        # Non-destructive walk over the transactions in priority order
+        return list(itertools.islice(self.ordered(), limit))
+
+    def _peek(self, heap):
+        while heap and self._seq.get(heap[0][-1]) != heap[0][1]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _compact(self):
+        # Rebuild the heap once stale entries dominate so they stay proportional to the pool
+        if len(self._worst) > 2 * len(self._by_id) + 64:
+            self._worst = [e for e in self._worst if self._seq.get(e[-1]) == e[1]]
+            heapq.heapify(self._worst)
+
+BLOCK_REWARD = 50
+BLOCK_MAX_BYTES = 1000000
+BLOCK_MAX_TRANSACTIONS = 5000
+
+class BlockTemplate:
+    # Candidate block body on top of one tip, grown as transactions arrive so mining can start at once
+    def __init__(self, previous_block: Block, max_bytes=BLOCK_MAX_BYTES, max_transactions=BLOCK_MAX_TRANSACTIONS):
+        self.index = previous_block.index + 1
+        self.previous_hash = previous_block.hash
+        self.max_bytes = max_bytes
+        self.max_transactions = max_transactions
+        self.transactions = []
+        self.tree = MerkleTree()
+        self.size = 0
+        self.fees = 0
+        self.min_fee_rate = None
+        # Senders with a transaction left out; their later ones must stay out to keep the order
+        self.blocked = set()
+        self._spending = {}
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def is_full(self):
+        return len(self.transactions) >= self.max_transactions
+
+    def fits(self, transaction: Transaction):
+        return not self.is_full() and self.size + transaction.size() <= self.max_bytes
+
+    def spending(self, sender):
+        return self._spending.get(sender, 0)
+
+    def add(self, transaction: Transaction):
+        self.transactions.append(transaction)
+        self.tree.append(transaction.digest())
+        self.size += transaction.size()
+        self.fees += transaction.fee
+        self._spending[transaction.sender] = self.spending(transaction.sender) + transaction.cost()
+        rate = transaction.fee_rate()
+        self.min_fee_rate = rate if self.min_fee_rate is None else min(self.min_fee_rate, rate)
+
+    def build_block(self, miner_address):
+        # The reward pays the subsidy plus every fee in the block and always comes last
+        reward = Transaction("Network", miner_address, BLOCK_REWARD + self.fees)
+        tree = self.tree.copy()
+        tree.append(reward.digest())
+        return Block(self.index, self.previous_hash, self.transactions + [reward], merkle_root=tree.root())
+
+def apply_block_to_balances(balances, block: Block):
+    for tx in block.transactions:
+        if tx.sender != "Network":
+            balances[tx.sender] = balances.get(tx.sender, 0) - tx.cost()
+        balances[tx.recipient] = balances.get(tx.recipient, 0) + tx.amount
+
+VALIDATION_BATCH_SIZE = 64
+VALIDATED_BLOCK_CACHE_SIZE = 10000
+
+# Block bodies (Merkle root and signatures) already checked, so blocks seen again skip the expensive part
+validated_blocks = SignatureCache(VALIDATED_BLOCK_CACHE_SIZE)
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def validate_headers(blocks: List[Block], previous: Block, schedule: TargetSchedule):
+    # Cheap serial pass: linkage, timestamp, median time past, header hash and proof-of-work
+    # against the schedule's target
+    now = time.time()
+    for block in blocks:
+        if block.index != previous.index + 1 or block.previous_hash != previous.hash:
+            logger.warning("Block %s does not link to block %s", block.index, previous.index)
+            return False
+        if not is_number(block.timestamp) or block.timestamp > now + MAX_FUTURE_BLOCK_SECONDS:
+            logger.warning("Block %s has an invalid timestamp", block.index)
+            return False
+        if block.timestamp <= schedule.median_time_past(block.index):
+            logger.warning("Block %s is not stamped after the median time of the blocks before it", block.index)
+            return False
+        if not block.meets_target(schedule.target_for(block.index)):
+            logger.warning("Block %s has an invalid hash or proof-of-work", block.index)
+            return False
+        previous = block
+    return True
+
+def _body_key(block: Block):
+    # The header only commits to the claimed Merkle root, so the key also covers every
+    # transaction payload and signature actually carried by this copy of the block
+    body = hashlib.sha256()
+    for tx in block.transactions:
+        body.update(tx.digest())
+        body.update((tx.signature or '').encode())
+    return (block.hash, body.digest())
+
+def _check_block_body(job):
+    # Runs in a worker: rebuild the Merkle root from the signed payloads and check the uncached signatures
+    merkle_root, messages, signatures = job
+    leaves = [hashlib.sha256(message.encode()).digest() for message in messages]
+    if MerkleTree(leaves).root() != merkle_root:
+        return None
+    return [verify_signature(*signature) for signature in signatures]
+
+def validate_block_bodies(blocks: List[Block]):
+    # One job per block, spread across the verification pool; returns a result per block
+    results = [True] * len(blocks)
+    pending = []
+    jobs = []
+    for i, block in enumerate(blocks):
+        key = _body_key(block)
+        if key in validated_blocks:
+            continue
+        signatures = []
+        signature_keys = []
+        for tx in block.transactions:
+            if tx.sender == "Network":
+                continue
+            if not tx.signature:
+                results[i] = False
+                break
+            signature_key = SignatureCache.key(tx.transaction_id, tx.digest(), tx.signature)
+            if signature_key not in signature_cache:
+                signatures.append((tx.sender, tx.signing_message(), tx.signature))
+                signature_keys.append(signature_key)
+        if results[i]:
+            pending.append((i, key, signature_keys))
+            jobs.append((block.merkle_root, [tx.signing_message() for tx in block.transactions], signatures))
+
+    with VERIFY_SECONDS.time():
+        signature_count = sum(len(job[2]) for job in jobs)
+        if len(jobs) > 1 and signature_count >= PARALLEL_VERIFY_THRESHOLD and (os.cpu_count() or 1) > 1:
+            outcomes = list(_get_verify_pool().map(_check_block_body, jobs))
+        else:
+            outcomes = [_check_block_body(job) for job in jobs]
+
+    for (i, key, signature_keys), outcome in zip(pending, outcomes):
+        if outcome is None:
+            logger.warning("Block %s has a Merkle root that does not match its transactions", blocks[i].index)
+            results[i] = False
+            continue
+        for signature_key, ok in zip(signature_keys, outcome):
+            SIGNATURES.inc(result='valid' if ok else 'invalid')
+            if ok:
+                signature_cache.add(signature_key)
+        if not all(outcome):
+            logger.warning("Block %s contains an invalid signature", blocks[i].index)
+            results[i] = False
+        else:
+            validated_blocks.add(key)
+    return results
+
+def check_block_transactions(block: Block):
+    # Every block after genesis moves positive amounts with non-negative fees and ends with
+    # exactly one reward from the Network, paying the subsidy plus the block's fees
+    if not block.transactions or block.transactions[-1].sender != "Network":
+        logger.warning("Block %s does not end with its reward", block.index)
+        return False
+    *transfers, reward = block.transactions
+    for tx in transfers:
+        if tx.sender == "Network":
+            logger.warning("Block %s pays more than one reward", block.index)
+            return False
+        if not tx.has_valid_amount() or not tx.has_valid_fee():
+            logger.warning("Transaction %s in block %s has an invalid amount or fee", tx.transaction_id, block.index)
+            return False
+    expected = BLOCK_REWARD + sum(tx.fee for tx in transfers)
+    if reward.fee != 0 or not is_number(reward.amount) or reward.amount != expected:
+        logger.warning("Block %s pays a reward of %s, expected %s", block.index, reward.amount, expected)
+        return False
+    return True
+
+def replay_balances(blocks: List[Block], balances, seen):
+    # Streaming pass in chain order; balances and seen transaction ids carry over between calls
+    for block in blocks:
+        if not check_block_transactions(block):
+            return False
+        for tx in block.transactions:
+            if tx.transaction_id in seen:
+                logger.warning("Transaction %s appears twice in the chain", tx.transaction_id)
+                return False
+            seen.add(tx.transaction_id)
+            if tx.sender != "Network":
+                if balances.get(tx.sender, 0) < tx.cost():
+                    logger.warning("Transaction %s in block %s overspends", tx.transaction_id, block.index)
+                    return False
+                balances[tx.sender] = balances.get(tx.sender, 0) - tx.cost()
+            balances[tx.recipient] = balances.get(tx.recipient, 0) + tx.amount
+    return True
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_REORG_JOURNAL = 1000
+HEADERS_PAGE_SIZE = 2000
+BLOCKS_PAGE_SIZE = 100
+SNAPSHOT_INTERVAL = 100
+TRANSACTION_INDEX_FILE = 'txindex.sqlite'
+
+class BlockStore:
+    # Index record: segment number, payload offset, payload length, block hash
+    INDEX_RECORD = struct.Struct('>IQI32s')
+    LENGTH_PREFIX = struct.Struct('>I')
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, cache_size=None, durable=True):
+        self.path = path
+        self.segment_size = segment_size
+        # None keeps every decoded block; a number keeps only that many recently used ones and
+        # reads the rest back from disk on demand
+        self.cache_size = cache_size
+        # Scratch stores that are thrown away anyway skip the fsync on every append
+        self.durable = durable
+        os.makedirs(path, exist_ok=True)
+        self._index = open(os.path.join(path, 'index.dat'), 'a+b')
+        self._length = os.path.getsize(self._index.name) // self.INDEX_RECORD.size
+        self._maps = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._recover()
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(self._length))]
+        if height < 0:
+            height += self._length
+        if not 0 <= height < self._length:
+            raise IndexError('block height out of range')
+        with self._lock:
+            block = self._cache.get(height)
+            if block is not None:
+                self._cache.move_to_end(height)
+                return block
+            segment, offset, length, _ = self._record(height)
+            payload = self._read(segment, offset, length)
+        # Stores written before the binary format hold JSON records
+        if payload[:1] == b'{':
+            block = Block.from_dict(json.loads(payload), trust_merkle_root=True)
+        else:
+            block = Block.from_bytes(payload, trust_merkle_root=True)
+        with self._lock:
+            self._remember(height, block)
+        return block
+
+    def __iter__(self):
+        for height in range(self._length):
+            yield self[height]
+
+    def append(self, block: Block):
+        payload = block.to_bytes()
+        segment, end = self._tail()
+        if end > 0 and end + self.LENGTH_PREFIX.size + len(payload) > self.segment_size:
+            segment, end = segment + 1, 0
+        with open(self._segment_path(segment), 'ab') as f:
+            f.write(self.LENGTH_PREFIX.pack(len(payload)) + payload)
+            f.flush()
+            if self.durable:
+                os.fsync(f.fileno())
+        self._index.write(self.INDEX_RECORD.pack(segment, end + self.LENGTH_PREFIX.size, len(payload), bytes.fromhex(block.hash)))
+        self._index.flush()
+        if self.durable:
+            os.fsync(self._index.fileno())
+        with self._lock:
+            self._remember(self._length, block)
+        self._length += 1
+
+    def truncate(self, height):
+        if height >= self._length:
+            return
+        segment, offset, _, _ = self._record(height)
+        with self._lock:
+            self._close_maps()
+            for h in range(height, self._length):
+                self._cache.pop(h, None)
+        with open(self._segment_path(segment), 'r+b') as f:
+            f.truncate(offset - self.LENGTH_PREFIX.size)
+        later = segment + 1
+        while os.path.exists(self._segment_path(later)):
+            os.remove(self._segment_path(later))
+            later += 1
+        self._index.truncate(height * self.INDEX_RECORD.size)
+        self._index.flush()
+        self._length = height
+
+    def load_snapshot(self):
+        try:
+            with open(os.path.join(self.path, 'state.json')) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        height = snapshot.get('height', -1)
+        if not 0 <= height < self._length or self._record(height)[3].hex() != snapshot.get('hash'):
+            return None
+        return snapshot
+
+    def save_snapshot(self, height, block_hash, balances, schedule=None):
+        path = os.path.join(self.path, 'state.json')
+        state = {'height': height, 'hash': block_hash, 'balances': balances}
+        if schedule is not None:
+            state.update(schedule)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        with self._lock:
+            self._close_maps()
+        self._index.close()
+
+    def _remember(self, height, block):
+        self._cache[height] = block
+        self._cache.move_to_end(height)
+        if self.cache_size is not None:
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f'blk{segment:05d}.dat')
+
+    def _record(self, height):
+        data = os.pread(self._index.fileno(), self.INDEX_RECORD.size, height * self.INDEX_RECORD.size)
+        return self.INDEX_RECORD.unpack(data)
+
+    def _tail(self):
+        if self._length == 0:
+            return 0, 0
+        segment, offset, length, _ = self._record(self._length - 1)
+        return segment, offset + length
+
+    def _read(self, segment, offset, length):
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < offset + length:
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapped
+        return mapped[offset:offset + length]
+
+    def _close_maps(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps = {}
+
+    def _recover(self):
+        # Drop a partially written index record and any index entries whose block data never reached disk
+        self._index.truncate(self._length * self.INDEX_RECORD.size)
+        while self._length > 0:
+            segment, offset, length, _ = self._record(self._length - 1)
+            path = self._segment_path(segment)
+            if os.path.exists(path) and os.path.getsize(path) >= offset + length:
+                break
+            self._length -= 1
+            self._index.truncate(self._length * self.INDEX_RECORD.size)
+        segment, end = self._tail()
+        if os.path.exists(self._segment_path(segment)) and os.path.getsize(self._segment_path(segment)) > end:
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.truncate(end)
+
+PEER_TIMEOUT = 3
+PEER_FANOUT_WORKERS = 16
+PEER_POOL_SIZE = 4
+BROADCAST_QUEUE_SIZE = 1000
+PEER_BACKOFF_BASE = 1
+PEER_BACKOFF_MAX = 60
+
+class PeerStats:
     def __init__(self):
-        self.chain = []
-        self.pending_transactions: List[Transaction] = []
-        self.wallet_balances = {}
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.backoff_until = 0
+
+    def record_success(self, elapsed):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.backoff_until = 0
+        # Exponentially weighted moving average keeps the latency figure cheap to maintain
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        delay = min(PEER_BACKOFF_MAX, PEER_BACKOFF_BASE * 2 ** (self.consecutive_failures - 1))
+        self.backoff_until = time.time() + delay
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+            'backing_off_for': max(0, round(self.backoff_until - time.time(), 2))
+        }
+
+class PeerNetwork:
+    def __init__(self, max_workers=PEER_FANOUT_WORKERS, queue_size=BROADCAST_QUEUE_SIZE):
+        self.stats = {}
+        self.dropped_broadcasts = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.queue_size = queue_size
+        # One bounded queue and sender thread per peer, so a slow peer only delays its own traffic
+        self._outbound = {}
+        self._senders = {}
+
+    def _session(self, node):
+        with self._lock:
+            session = self._sessions.get(node)
+            if session is None:
+                # One keep-alive connection pool per peer
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PEER_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[node] = session
+                self.stats[node] = PeerStats()
+            return session
+
+    def is_available(self, node):
+        stats = self.stats.get(node)
+        return stats is None or stats.backoff_until <= time.time()
+
+    def request(self, node, method, path, **kwargs):
+        session = self._session(node)
+        stats = self.stats[node]
+        if not self.is_available(node):
+            raise requests.exceptions.ConnectionError(f"{node} is backing off after {stats.consecutive_failures} failures")
+        kwargs.setdefault('timeout', PEER_TIMEOUT)
+        start = time.perf_counter()
+        try:
+            response = session.request(method, f'http://{node}{path}', **kwargs)
+        except requests.exceptions.RequestException:
+            stats.record_failure()
+            PEER_FAILURES.inc(peer=node)
+            raise
+        elapsed = time.perf_counter() - start
+        PEER_REQUEST_SECONDS.observe(elapsed, path=path)
+        if response.status_code >= 500:
+            stats.record_failure()
+            PEER_FAILURES.inc(peer=node)
+        else:
+            stats.record_success(elapsed)
+        return response
+
+    def fan_out(self, nodes, method, path, **kwargs):
+        # Returns {node: response or exception}, querying every available peer in parallel
+        futures = {
+            node: self._executor.submit(self.request, node, method, path, **kwargs)
+            for node in list(nodes) if self.is_available(node)
+        }
+        results = {}
+        for node, future in futures.items():
+            try:
+                results[node] = future.result()
+            except requests.exceptions.RequestException as e:
+                results[node] = e
+        return results
+
+    def relay(self, nodes, exchange, description):
+        # Queues exchange(node) for every peer; it may make several requests to the same peer.
+        # Returns False if any peer's queue was full and it missed this one
+        queued = True
+        for node in list(nodes):
+            try:
+                self._queue_for(node).put_nowait((exchange, description))
+            except queue.Full:
+                self.dropped_broadcasts += 1
+                queued = False
+                continue
+            self._start_sender(node)
+        return queued
+
+    def queued(self):
+        return sum(outbound.qsize() for outbound in list(self._outbound.values()))
+
+    def _queue_for(self, node):
+        with self._lock:
+            outbound = self._outbound.get(node)
+            if outbound is None:
+                outbound = self._outbound[node] = queue.Queue(maxsize=self.queue_size)
+            return outbound
+
+    def _start_sender(self, node):
+        with self._lock:
+            sender = self._senders.get(node)
+            if sender is None or not sender.is_alive():
+                sender = threading.Thread(target=self._drain, args=(node, self._outbound[node]),
+                                          name=f'peer-broadcast-{node}', daemon=True)
+                self._senders[node] = sender
+                sender.start()
+
+    def _drain(self, node, outbound):
+        while True:
+            exchange, description = outbound.get()
+            try:
+                if self.is_available(node):
+                    exchange(node)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.warning("Broadcast %s to %s failed: %s", description, node, e)
+            except Exception:
+                # A peer answering with something unexpected must not stop its sender thread
+                logger.exception("Broadcast %s to %s raised", description, node)
+            finally:
+                outbound.task_done()
+
+    def to_dict(self):
+        return {
+            'peers': {node: dict(stats.to_dict(), queued_broadcasts=self._outbound[node].qsize() if node in self._outbound else 0)
+                      for node, stats in self.stats.items()},
+            'queued_broadcasts': self.queued(),
+            'dropped_broadcasts': self.dropped_broadcasts
+        }
+
+class ChainIndex:
+    def __init__(self, ready=True):
+        # transaction_id -> (height, position); address -> [(height, position), ...] in chain order
+        self.locations = {}
+        self.history = {}
+        self.ready = ready
+
+    def ensure(self, chain):
+        # Stores opened from disk build their index on first query instead of at startup
+        if not self.ready:
+            self.ready = True
+            for block in chain:
+                self.add_block(block)
+
+    def add_block(self, block: Block):
+        if not self.ready:
+            return
+        for position, tx in enumerate(block.transactions):
+            ref = (block.index, position)
+            self.locations[tx.transaction_id] = ref
+            for address in {tx.sender, tx.recipient}:
+                if address != "Network":
+                    self.history.setdefault(address, []).append(ref)
+
+    def remove_block(self, block: Block):
+        if not self.ready:
+            return
+        for tx in block.transactions:
+            if self.locations.get(tx.transaction_id, (None,))[0] == block.index:
+                del self.locations[tx.transaction_id]
+            for address in {tx.sender, tx.recipient}:
+                refs = self.history.get(address)
+                while refs and refs[-1][0] == block.index:
+                    refs.pop()
+                if refs == []:
+                    del self.history[address]
+
+    def locate(self, transaction_id):
+        return self.locations.get(transaction_id)
+
+    def address_history(self, address, offset=0, limit=50):
+        # Newest first
+        refs = self.history.get(address, [])
+        end = max(len(refs) - offset, 0)
+        return len(refs), refs[max(end - limit, 0):end][::-1]
+
+class StoredChainIndex:
+    # ChainIndex kept in SQLite beside the block store: it survives restarts, so opening a store
+    # only indexes the blocks appended since the last run, and its pages stay on disk
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, hash TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS transactions (transaction_id TEXT PRIMARY KEY, height INTEGER NOT NULL, position INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS history (address TEXT NOT NULL, height INTEGER NOT NULL, position INTEGER NOT NULL, '
+        'PRIMARY KEY (address, height, position)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS transactions_height ON transactions (height)',
+        'CREATE INDEX IF NOT EXISTS history_height ON history (height)'
+    )
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def ensure(self, chain):
+        if self.ready:
+            return
+        with self._lock, self.db:
+            # Walk back past blocks the store lost or a reorg replaced while we were not running,
+            # then index whatever the store gained
+            indexed = min(self.db.execute('SELECT COALESCE(MAX(height) + 1, 0) FROM blocks').fetchone()[0], len(chain))
+            while indexed > 0 and self._hash_at(indexed - 1) != chain[indexed - 1].hash:
+                indexed -= 1
+            for table in ('blocks', 'transactions', 'history'):
+                self.db.execute(f'DELETE FROM {table} WHERE height >= ?', (indexed,))
+            for height in range(indexed, len(chain)):
+                self._insert(chain[height])
+            self.ready = True
+        if indexed < len(chain):
+            logger.info("Indexed %d blocks into %s", len(chain) - indexed, TRANSACTION_INDEX_FILE)
+
+    def add_block(self, block: Block):
+        if not self.ready:
+            return
+        with self._lock, self.db:
+            self._insert(block)
+
+    def remove_block(self, block: Block):
+        if not self.ready:
+            return
+        with self._lock, self.db:
+            for table in ('blocks', 'transactions', 'history'):
+                self.db.execute(f'DELETE FROM {table} WHERE height = ?', (block.index,))
+
+    def locate(self, transaction_id):
+        with self._lock:
+            row = self.db.execute('SELECT height, position FROM transactions WHERE transaction_id = ?',
+                                  (transaction_id,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def address_history(self, address, offset=0, limit=50):
+        # Newest first
+        with self._lock:
+            total = self.db.execute('SELECT COUNT(*) FROM history WHERE address = ?', (address,)).fetchone()[0]
+            refs = self.db.execute('SELECT height, position FROM history WHERE address = ? '
+                                   'ORDER BY height DESC, position DESC LIMIT ? OFFSET ?',
+                                   (address, max(limit, 0), max(offset, 0))).fetchall()
+        return total, [tuple(ref) for ref in refs]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def _hash_at(self, height):
+        row = self.db.execute('SELECT hash FROM blocks WHERE height = ?', (height,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _insert(self, block: Block):
+        self.db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?)', (block.index, block.hash))
+        self.db.executemany('INSERT OR REPLACE INTO transactions VALUES (?, ?, ?)',
+                            [(tx.transaction_id, block.index, position) for position, tx in enumerate(block.transactions)])
+        self.db.executemany('INSERT OR IGNORE INTO history VALUES (?, ?, ?)',
+                            [(address, block.index, position) for position, tx in enumerate(block.transactions)
+                             for address in {tx.sender, tx.recipient} if address != "Network"])
+
+BALANCE_LAYERS_MAX = 32
+_DELETED = object()
+
+class Balances(MutableMapping):
+    # Copy-on-write wallet balances. A writer works on a new layer over the published map and
+    # only records the addresses it changes, so connecting a block costs what the block touches
+    # instead of a copy of every address. Layers are folded into a new base once they get deep
+    def __init__(self, base=None, layers=()):
+        self._base = base if base is not None else {}
+        # Frozen layers, newest first, under the writable top layer
+        self._layers = list(layers)
+        self._top = {}
+
+    def derive(self):
+        # A writable map over this one; this one must not be written to afterwards
+        layers = [self._top] + self._layers if self._top else self._layers
+        if len(layers) >= BALANCE_LAYERS_MAX:
+            return Balances(self.to_dict())
+        return Balances(self._base, layers)
+
+    def to_dict(self):
+        merged = dict(self._base)
+        for layer in reversed([self._top] + self._layers):
+            for address, balance in layer.items():
+                if balance is _DELETED:
+                    merged.pop(address, None)
+                else:
+                    merged[address] = balance
+        return merged
+
+    def __getitem__(self, address):
+        if address in self._top:
+            balance = self._top[address]
+        else:
+            for layer in self._layers:
+                if address in layer:
+                    balance = layer[address]
+                    break
+            else:
+                return self._base[address]
+        if balance is _DELETED:
+            raise KeyError(address)
+        return balance
+
+    def __setitem__(self, address, balance):
+        self._top[address] = balance
+
+    def __delitem__(self, address):
+        if address not in self:
+            raise KeyError(address)
+        self._top[address] = _DELETED
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+class ChainSnapshot:
+    # Immutable view published after every write; the chain object is only ever appended to
+    # or copied, so entries below length never change underneath a reader
+    def __init__(self, chain, length, balances):
+        self.chain = chain
+        self.length = length
+        self.balances = balances
+        self.tip = chain[length - 1] if length else None
+
+    def __len__(self):
+        return self.length
+
+    def blocks(self, start=0, stop=None):
+        stop = self.length if stop is None else min(stop, self.length)
+        for height in range(max(start, 0), stop):
+            yield self.chain[height]
+
+    def find_fork_point(self, locator):
+        for height, block_hash in locator:
+            if 0 <= height < self.length and self.chain[height].hash == block_hash:
+                return height
+        return -1
+
+MINING_ATTEMPTS = 3
+HASHRATE_SMOOTHING = 0.3
+
+def short_transaction_id(block_hash, transaction_id):
+    # Salted with the block hash so nobody can precompute colliding ids for a block they did not mine
+    return hashlib.sha256((block_hash + transaction_id).encode()).hexdigest()[:12]
+
+class Blockchain:
+    def __init__(self, data_dir=None, wire_format='binary', block_max_bytes=BLOCK_MAX_BYTES, block_max_transactions=BLOCK_MAX_TRANSACTIONS,
+                 prune_keep=None, checkpoint_interval=SNAPSHOT_INTERVAL):
+        self.store = BlockStore(data_dir, cache_size=prune_keep) if data_dir else None
+        self.checkpoint_interval = checkpoint_interval
+        self.wire_format = wire_format
+        self.block_max_bytes = block_max_bytes
+        self.block_max_transactions = block_max_transactions
+        self._template = None
+        self.chain = self.store if self.store is not None else []
+        self.mempool = Mempool()
+        self.wallet_balances = Balances()
         self.nodes = set()
-        self.create_genesis_block()
+        self.peers = PeerNetwork()
+        self.last_mining_stats = None
+        # Per-block balance undo records for the most recent blocks, used to roll back on reorgs
+        self.undo_journal = deque(maxlen=MAX_REORG_JOURNAL)
+        if self.store is not None:
+            self.index = StoredChainIndex(os.path.join(data_dir, TRANSACTION_INDEX_FILE))
+        else:
+            self.index = ChainIndex()
+        self.targets = TargetSchedule(lambda height: self.chain[height])
+        self.hashrate = None
+        # Writers serialize on the lock; readers use the latest published snapshot
+        self.lock = threading.RLock()
+        self._reorganizing = False
+        self._stale_balances = False
+        self._sync_lock = threading.Lock()
+        self._sync_running = False
+        self._sync_again = False
+        self._publish()
+        if len(self.chain) == 0:
+            self.create_genesis_block()
+        else:
+            self._load_state()
+        if self.store is not None:
+            # Normally just the blocks stored after the index's last commit
+            self.index.ensure(self.chain)
+        self._publish()
+
+    def _publish(self):
+        self.snapshot = ChainSnapshot(self.chain, len(self.chain), self.wallet_balances)
+
+    def _writable_balances(self):
+        # Copy-on-write: the published balances must never change once readers can see them
+        if self.wallet_balances is self.snapshot.balances:
+            self.wallet_balances = self.wallet_balances.derive()
+        return self.wallet_balances
+
+    def _load_state(self):
+        snapshot = self.store.load_snapshot()
+        if snapshot and TargetSchedule.valid_state(snapshot.get('targets'), snapshot.get('work')):
+            # Epoch targets up to the snapshot, so startup does not re-read every epoch's boundary blocks
+            self.targets = TargetSchedule(self.targets.block_at, snapshot['targets'], snapshot['work'])
+        replayed = self._rebuild_balances(snapshot)
+        logger.info("Loaded %d blocks from %s, replayed %d", len(self.chain), self.store.path, replayed)
+
+    def _rebuild_balances(self, snapshot):
+        # Start from a balance snapshot still on our chain, or genesis when there is none, and
+        # replay only the blocks after it; returns how many blocks were replayed
+        if snapshot:
+            balances = snapshot['balances']
+            start = snapshot['height'] + 1
+        else:
+            balances = {"Network": 0}
+            start = 0
+        for height in range(start, len(self.chain)):
+            apply_block_to_balances(balances, self.chain[height])
+        self.wallet_balances = Balances(balances)
+        self._stale_balances = False
+        return len(self.chain) - start
+
+    def _save_snapshot(self):
+        if self.store is not None:
+            tip = self.chain[-1]
+            self.store.save_snapshot(tip.index, tip.hash, self.wallet_balances.to_dict(), self.targets.to_dict(len(self.chain)))
+
+    def close(self):
+        if self.store is not None:
+            self._save_snapshot()
+            self.store.close()
+            self.index.close()
 
     def create_genesis_block(self):
         genesis_transactions = []
         genesis_block = Block(0, "0", genesis_transactions, 0)
         genesis_block.timestamp = 1672531200 
-        genesis_block.mine_block()
+        # Mine serially: the genesis block is built at import time, before worker processes are safe to start
+        genesis_block.mine_block(workers=1)
         self.chain.append(genesis_block)
         # Initialize Network with 0 balance
         self.wallet_balances["Network"] = 0
 
     def add_block(self, block: Block):
-        # Validate all transactions in the block before adding
+        with self.lock, BLOCK_APPLY_SECONDS.time():
+            accepted = self._add_block(block)
+            if accepted and not self._reorganizing:
+                # The template is rebuilt lazily by the next block_template() call
+                self._template = None
+                self._publish()
+        BLOCKS.inc(result='accepted' if accepted else 'rejected')
+        return accepted
+
+    def _add_block(self, block: Block):
+        # Validate all transactions in the block before adding, in order, so a sender
+        # cannot spend the same balance twice within one block
+        if not check_block_transactions(block):
+            return False
+        self._ensure_index()
+        seen = set()
+        changes = {}
         for tx in block.transactions:
+            if tx.transaction_id in seen or self.index.locate(tx.transaction_id) is not None:
+                logger.warning("Transaction %s invalid: already spent", tx.transaction_id)
+                return False
+            seen.add(tx.transaction_id)
             if tx.sender != "Network":
                 # Check if sender has enough balance
-                sender_balance = self.wallet_balances.get(tx.sender, 0)
-                if sender_balance < tx.amount:
-                    print(f"Transaction {tx.transaction_id} invalid: insufficient funds")
+                sender_balance = self.wallet_balances.get(tx.sender, 0) + changes.get(tx.sender, 0)
+                if sender_balance < tx.cost():
+                    logger.warning("Transaction %s invalid: insufficient funds", tx.transaction_id)
                     return False
+                changes[tx.sender] = changes.get(tx.sender, 0) - tx.cost()
+            changes[tx.recipient] = changes.get(tx.recipient, 0) + tx.amount
+
+        if block.previous_hash != self.chain[-1].hash or block.index != len(self.chain):
+            logger.warning("Block %s does not extend our tip", block.index)
+            return False
+        if not validate_headers([block], self.chain[-1], self.targets):
+            return False
+
+        self._writable_balances()
+
+        # Remember the balances this block touches so it can be disconnected on a reorg
+        undo = {}
+        for tx in block.transactions:
+            for address in (tx.sender, tx.recipient):
+                if address != "Network" and address not in undo:
+                    undo[address] = self.wallet_balances.get(address)
+        self.undo_journal.append((block.hash, undo))
+        self._template = None
 
         # If all transactions are valid, apply them to balances
         for tx in block.transactions:
@@ -154,184 +1837,798 @@ class Blockchain:
                 # Initialize sender balance to 0 if not exists
                 if tx.sender not in self.wallet_balances:
                     self.wallet_balances[tx.sender] = 0
-                # Subtract amount from sender
-                self.wallet_balances[tx.sender] -= tx.amount
-                print(f"Subtracted {tx.amount} from {tx.sender[:50]}..., new balance: {self.wallet_balances[tx.sender]}")
+                # Subtract amount and fee from sender
+                self.wallet_balances[tx.sender] -= tx.cost()
+                logger.debug("Subtracted %s from %.50s..., new balance: %s", tx.cost(), tx.sender, self.wallet_balances[tx.sender])
             
             # Initialize recipient balance to 0 if not exists
             if tx.recipient not in self.wallet_balances:
                 self.wallet_balances[tx.recipient] = 0
             # Add amount to recipient
             self.wallet_balances[tx.recipient] += tx.amount
-            print(f"Added {tx.amount} to {tx.recipient[:50]}..., new balance: {self.wallet_balances[tx.recipient]}")
+            logger.debug("Added %s to %.50s..., new balance: %s", tx.amount, tx.recipient, self.wallet_balances[tx.recipient])
 
         # Add block to chain
         self.chain.append(block)
+        self.index.add_block(block)
+        if self.store is not None and block.index % self.checkpoint_interval == 0:
+            self._save_snapshot()
 
         # Remove processed transactions from pending pool
-        block_tx_ids = set(tx.transaction_id for tx in block.transactions)
-        self.pending_transactions = [tx for tx in self.pending_transactions if tx.transaction_id not in block_tx_ids]
+        self.mempool.remove_many(tx.transaction_id for tx in block.transactions)
+        self._evict_overdrawn(tx.sender for tx in block.transactions)
 
         return True
 
+    def available_balance(self, address, balances=None):
+        # Confirmed balance minus what the address has already committed in the pending pool
+        balances = self.wallet_balances if balances is None else balances
+        return balances.get(address, 0) - self.mempool.spending(address)
+
+    def _evict_overdrawn(self, addresses):
+        # A block or reorg can lower a confirmed balance below what is pending against it;
+        # drop that sender's newest pending transactions until the rest fit again
+        for address in set(addresses):
+            if address == "Network":
+                continue
+            pending = self.mempool.by_sender(address)
+            while pending and self.available_balance(address) < 0:
+                tx = pending.pop()
+                self.mempool.remove(tx.transaction_id)
+                logger.info("Evicted pending transaction %s: no longer funded", tx.transaction_id)
+
+    def disconnect_tip(self):
+        with self.lock:
+            (block,) = self._disconnect_to(len(self.chain) - 2)
+            if not self._reorganizing:
+                self._publish()
+            return block
+
+    def _disconnect_to(self, height):
+        # Disconnects blocks until `height` is the tip, newest first. Balances are replayed at
+        # most once, when the undo journal runs out, and pending transactions are only evicted
+        # once the balances are right again
+        disconnected = []
+        while len(self.chain) > height + 1:
+            disconnected.append(self._disconnect_tip())
+        if self._stale_balances:
+            replayed = self._rebuild_balances(self.store.load_snapshot() if self.store is not None else None)
+            logger.info("Undo journal exhausted, replayed %d blocks to rebuild balances", replayed)
+        self._evict_overdrawn(tx.recipient for block in disconnected for tx in block.transactions)
+        return disconnected
+
+    def _disconnect_tip(self):
+        block = self.chain[-1]
+        self._writable_balances()
+        self._template = None
+        if self.undo_journal and self.undo_journal[-1][0] == block.hash:
+            _, undo = self.undo_journal.pop()
+            for address, balance in undo.items():
+                if balance is None:
+                    self.wallet_balances.pop(address, None)
+                else:
+                    self.wallet_balances[address] = balance
+        else:
+            # Deeper than the journal reaches: _disconnect_to replays the remaining chain once
+            self._stale_balances = True
+
+        if self.store is not None:
+            self.store.truncate(len(self.chain) - 1)
+        elif self.chain is self.snapshot.chain:
+            self.chain = self.chain[:-1]
+        else:
+            self.chain.pop()
+        self.index.remove_block(block)
+        self.targets.truncate(len(self.chain))
+        return block
+
+    def block_locator(self):
+        # Dense near the tip, exponentially sparser towards genesis
+        snapshot = self.snapshot
+        locator = []
+        height = len(snapshot) - 1
+        step = 1
+        while height > 0:
+            locator.append([height, snapshot.chain[height].hash])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append([0, snapshot.chain[0].hash])
+        return locator
+
+    def _ensure_index(self):
+        if not self.index.ready:
+            with self.lock:
+                self.index.ensure(self.chain)
+
+    def find_transaction(self, transaction_id):
+        self._ensure_index()
+        ref = self.index.locate(transaction_id)
+        if ref is None:
+            return None, None, None
+        height, position = ref
+        block = self.chain[height]
+        return block.transactions[position], block, position
+
+    def address_history(self, address, offset=0, limit=50):
+        self._ensure_index()
+        total, refs = self.index.address_history(address, offset, limit)
+        return total, [(self.chain[height], position) for height, position in refs]
+
+    def ensure_wallet(self, public_key):
+        with self.lock:
+            if public_key not in self.wallet_balances:
+                self._writable_balances()[public_key] = 0
+                self._publish()
+
+    def pending_transactions(self):
+        with self.lock:
+            return self.mempool.select()
+
+    def _admit(self, transaction: Transaction):
+        # O(1) admission against the pending-state overlay; caller holds the lock and has
+        # already checked the signature
+        if transaction.transaction_id in self.mempool:
+            return 'duplicate'
+        self._ensure_index()
+        if self.index.locate(transaction.transaction_id) is not None:
+            return 'confirmed'
+        # Only a block's reward may come from the Network, and nothing may move a zero or negative amount
+        if transaction.sender == "Network" or not transaction.has_valid_amount() or not transaction.has_valid_fee():
+            return 'invalid'
+        if self.available_balance(transaction.sender) < transaction.cost():
+            return 'insufficient_funds'
+        full = len(self.mempool) >= self.mempool.max_size
+        if not self.mempool.add(transaction):
+            return 'rejected'
+        self._extend_template(transaction, evicted=full)
+        return 'accepted'
+
+    def _prevalidate(self, template, transaction: Transaction):
+        # Checks the transaction against the tip the template builds on, including what the
+        # template already spends for the same sender
+        if self.index.locate(transaction.transaction_id) is not None:
+            return False
+        if transaction.sender == "Network":
+            return True
+        balance = self.wallet_balances.get(transaction.sender, 0) - template.spending(transaction.sender)
+        return balance >= transaction.cost()
+
+    def _build_template(self):
+        # Fill a fresh template from the pool in fee-rate order; caller holds the lock
+        self._ensure_index()
+        template = BlockTemplate(self.chain[-1], self.block_max_bytes, self.block_max_transactions)
+        stale = []
+        for tx in self.mempool.ordered():
+            if template.is_full():
+                break
+            if tx.sender in template.blocked:
+                continue
+            if not self._prevalidate(template, tx):
+                stale.append(tx.transaction_id)
+                template.blocked.add(tx.sender)
+            elif template.fits(tx):
+                template.add(tx)
+            else:
+                template.blocked.add(tx.sender)
+        if stale:
+            logger.info("Dropped %d pending transactions that are no longer valid", len(stale))
+            self.mempool.remove_many(stale)
+        self._template = template
+        return template
+
+    def _extend_template(self, transaction: Transaction, evicted=False):
+        template = self._template
+        if template is None:
+            return
+        if evicted:
+            # The pool made room by evicting a transaction that may be in the template
+            self._template = None
+        elif transaction.sender not in template.blocked and template.fits(transaction) and self._prevalidate(template, transaction):
+            template.add(transaction)
+        else:
+            template.blocked.add(transaction.sender)
+            if template.min_fee_rate is not None and transaction.fee_rate() > template.min_fee_rate:
+                # A better-paying transaction was left out; rebuild before the next mining round
+                self._template = None
+
+    def block_template(self):
+        with self.lock:
+            template = self._template
+            if template is None or template.previous_hash != self.chain[-1].hash:
+                template = self._build_template()
+            return template
+
     def add_transaction(self, transaction: Transaction):
-        # For regular transactions, validate the sender has enough balance
-        if transaction.sender != "Network":
-            sender_balance = self.wallet_balances.get(transaction.sender, 0)
-            if sender_balance < transaction.amount:
-                print(f"Insufficient funds: {transaction.sender} has {sender_balance}, needs {transaction.amount}")
-                return False
+        if transaction.sender == "Network" or not transaction.has_valid_amount() or not transaction.has_valid_fee():
+            logger.info("Invalid sender, amount or fee on transaction %s", transaction.transaction_id)
+            return False
+        # Validate the sender has enough balance before paying for the signature check
+        available = self.available_balance(transaction.sender, self.snapshot.balances)
+        if available < transaction.cost():
+            logger.info("Insufficient funds: %s has %s available, needs %s", transaction.sender, available, transaction.cost())
+            return False
         
+        # Signature checks run outside the lock; only the pool update is serialized
         if transaction.is_valid():
-            # Check for duplicate transaction_id in pending pool
-            if any(tx.transaction_id == transaction.transaction_id for tx in self.pending_transactions):
-                print("Duplicate transaction in pending pool")
+            with self.lock:
+                status = self._admit(transaction)
+            if status != 'accepted':
+                logger.info("Transaction %s not added to pending pool: %s", transaction.transaction_id, status)
                 return False
-
-            self.pending_transactions.append(transaction)
-            print(f"Transaction added to pending pool: {transaction.to_dict(include_signature=True)}")
+            logger.debug("Transaction added to pending pool: %s", transaction.transaction_id)
             
-            # Broadcast transaction to other nodes
-            for node in list(self.nodes):
-                try:
-                    requests.post(f'http://{node}/transactions/receive', 
-                                 json=transaction.to_dict(include_signature=True), 
-                                 timeout=3)
-                except requests.exceptions.RequestException:
-                    pass
+            # Announce the transaction to other nodes off the request path
+            self.announce_transactions([transaction])
             return True
-        print("Invalid transaction")
+        logger.info("Invalid transaction")
         return False
 
+    def _wire_body(self, transaction: Transaction):
+        if self.wire_format == 'binary':
+            return {'data': transaction.to_bytes(), 'headers': {'Content-Type': BINARY_MIMETYPE}}
+        return {'json': transaction.to_dict(include_signature=True)}
+
+    def _wire_bulk_body(self, transactions: List[Transaction]):
+        if self.wire_format == 'binary':
+            return {'data': pack_frames(tx.to_bytes() for tx in transactions), 'headers': {'Content-Type': BINARY_MIMETYPE}}
+        return {'json': {'transactions': [tx.to_dict(include_signature=True) for tx in transactions]}}
+
+    def _wire_accept(self, fallback='application/json'):
+        if self.wire_format == 'binary':
+            return {'Accept': f'{BINARY_MIMETYPE}, {fallback};q=0.9'}
+        return {'Accept': fallback}
+
     def receive_remote_transaction(self, transaction: Transaction):
-        if any(tx.transaction_id == transaction.transaction_id for tx in self.pending_transactions):
+        if not _well_formed(transaction) or transaction.transaction_id in self.mempool:
             return False
-        if transaction.is_valid():
-            self.pending_transactions.append(transaction)
-            print("Received and added remote transaction to pending pool:", transaction.transaction_id)
-            return True
-        return False
+        if not transaction.is_valid():
+            return False
+        with self.lock:
+            if self._admit(transaction) != 'accepted':
+                return False
+        logger.debug("Received and added remote transaction to pending pool: %s", transaction.transaction_id)
+        self.announce_transactions([transaction])
+        return True
+
+    def receive_remote_transactions(self, transactions: List[Transaction]):
+        return ['duplicate' if status == 'confirmed' else status for status in self.add_transactions(transactions)]
+
+    def add_transactions(self, transactions: List[Transaction]):
+        # One parallel signature pass, one lock acquisition and one announcement for the whole
+        # batch; returns an admission status per transaction
+        results = []
+        fresh = []
+        seen = set()
+        for tx in transactions:
+            if not _well_formed(tx):
+                results.append('malformed')
+            elif tx.transaction_id in self.mempool or tx.transaction_id in seen:
+                results.append('duplicate')
+            else:
+                seen.add(tx.transaction_id)
+                results.append(None)
+                fresh.append(tx)
+
+        verified = iter(verify_transactions(fresh))
+        try:
+            with self.lock:
+                for i, tx in enumerate(transactions):
+                    if results[i] is not None:
+                        continue
+                    if not next(verified):
+                        results[i] = 'invalid'
+                    else:
+                        results[i] = self._admit(tx)
+        finally:
+            # Whatever made it into the pool is announced, even if a later item raised
+            accepted = [tx for tx, status in zip(transactions, results) if status == 'accepted']
+            if accepted:
+                logger.debug("Added %d transactions to pending pool", len(accepted))
+                self.announce_transactions(accepted)
+        return results
 
     def _gather_pending_from_network(self):
-        gathered = {tx.transaction_id: tx for tx in self.pending_transactions}
-        for node in self.nodes:
-            try:
-                resp = requests.get(f'http://{node}/transactions/pending', timeout=3)
-                if resp.status_code == 200:
-                    remote_list = resp.json().get('pending', [])
-                    for txd in remote_list:
-                        tx = Transaction.from_dict(txd)
-                        if tx.transaction_id not in gathered:
-                            gathered[tx.transaction_id] = tx
-            except requests.exceptions.RequestException as e:
-                print(f"Failed to fetch pending from {node}: {e}")
-        return list(gathered.values())
+        # Peers' pending transactions go through the same admission as gossip, so every
+        # transaction in the pool is funded and a template built from it is valid
+        responses = self.peers.fan_out(self.nodes, 'GET', '/transactions/pending', headers=self._wire_accept())
+        for node, resp in responses.items():
+            if isinstance(resp, Exception):
+                logger.warning("Failed to fetch pending from %s: %s", node, resp)
+            elif resp.status_code == 200:
+                try:
+                    if resp.headers.get('Content-Type', '').startswith(BINARY_MIMETYPE):
+                        remote = [Transaction.from_bytes(payload) for payload in unpack_frames(resp.content)]
+                    else:
+                        remote = [Transaction.from_dict(txd) for txd in resp.json().get('pending', [])]
+                except (ValueError, IndexError, TypeError, AttributeError, struct.error) as e:
+                    logger.warning("Malformed pending transactions from %s: %s", node, e)
+                    continue
+                self.receive_remote_transactions(remote)
 
     def mine_pending_transactions(self, miner_address):
         # Gather pending transactions from network
-        merged_pending = self._gather_pending_from_network()
+        self._gather_pending_from_network()
 
-        # Create mining reward transaction
-        reward_transaction = Transaction("Network", miner_address, 50)
+        for attempt in range(MINING_ATTEMPTS):
+            # Build the template under the lock, then hash without it so readers and writers keep going
+            with self.lock:
+                # The template is kept current as transactions arrive, so this is normally just a copy
+                template = self.block_template()
+                new_block = template.build_block(miner_address)
+                # The smallest float step past the median keeps the block valid without running ahead of the clock
+                new_block.timestamp = max(new_block.timestamp, math.nextafter(self.targets.median_time_past(new_block.index), math.inf))
+                target = self.targets.target_for(new_block.index)
+            block_transactions = new_block.transactions
 
-        # Prepare block transactions
-        block_transactions = merged_pending.copy()
-        block_transactions.append(reward_transaction)
+            # Create and mine the block
+            stats = new_block.mine_block(target=target)
+            if stats['hashes']:
+                self._record_hashrate(stats['hashrate'])
+            stats['expected_seconds'] = self.expected_block_seconds(target)
+            self.last_mining_stats = stats
+            logger.info("Mined block %d at difficulty %.2f: %d hashes in %.2fs (%.0f H/s)", new_block.index, stats['difficulty'],
+                        stats['hashes'], stats['seconds'], stats['hashrate'])
 
-        # Create and mine the block
-        last_block = self.chain[-1]
-        new_block = Block(len(self.chain), last_block.hash, block_transactions)
-        new_block.mine_block()
+            # Add block to chain unless another block arrived while we were hashing
+            with self.lock:
+                if self.chain[-1].hash != new_block.previous_hash:
+                    logger.info("Tip moved while mining block %d, rebuilding template", new_block.index)
+                    continue
+                if self.add_block(new_block):
+                    logger.info("Block %d mined successfully with %d transactions", new_block.index, len(block_transactions))
+                    return new_block
+                logger.warning("Failed to add block %d - invalid transactions", new_block.index)
+                return None
+        return None
 
-        # Add block to chain
-        if self.add_block(new_block):
-            print(f"Block {new_block.index} mined successfully with {len(block_transactions)} transactions")
-            return new_block
+    def _record_hashrate(self, hashrate):
+        # Exponentially weighted so one lucky or unlucky block does not swing the estimate
+        if self.hashrate is None:
+            self.hashrate = hashrate
         else:
-            print(f"Failed to add block {new_block.index} - invalid transactions")
+            self.hashrate += HASHRATE_SMOOTHING * (hashrate - self.hashrate)
+
+    def expected_block_seconds(self, target):
+        if not self.hashrate:
             return None
+        return round(expected_hashes(target) / self.hashrate, 3)
+
+    def mining_info(self):
+        with self.lock:
+            height = len(self.chain)
+            target = self.targets.target_for(height)
+            window = [self.chain[h] for h in range(max(0, height - RETARGET_INTERVAL), height)]
+        # Observed spacing of recent blocks, and the hashrate that spacing implies for the whole network
+        spacing = (window[-1].timestamp - window[0].timestamp) / (len(window) - 1) if len(window) > 1 else None
+        return {
+            'height': height,
+            'difficulty': round(target_to_difficulty(target), 4),
+            'target': format(target, '064x'),
+            'expected_hashes': round(expected_hashes(target)),
+            'target_block_seconds': TARGET_BLOCK_SECONDS,
+            'retarget_interval': RETARGET_INTERVAL,
+            'next_retarget_height': (height // RETARGET_INTERVAL + 1) * RETARGET_INTERVAL,
+            'average_block_seconds': round(spacing, 3) if spacing is not None else None,
+            'network_hashrate': round(expected_hashes(target) / spacing, 2) if spacing else None,
+            'hashrate': round(self.hashrate, 2) if self.hashrate is not None else None,
+            'expected_seconds': self.expected_block_seconds(target)
+        }
+
+    def announce_transactions(self, transactions: List[Transaction]):
+        # Peers get the ids first and only the transactions they ask for
+        by_id = {tx.transaction_id: tx for tx in transactions}
+        self.peers.relay(self.nodes, functools.partial(self._offer_transactions, by_id), 'transaction announcement')
+
+    def _offer_transactions(self, by_id, node):
+        response = self.peers.request(node, 'POST', '/inv', json={'transactions': list(by_id)})
+        if response.status_code == 404:
+            # Peer predates inventory gossip; push the transactions in full
+            self.peers.request(node, 'POST', '/transactions/receive/bulk', **self._wire_bulk_body(list(by_id.values())))
+            return
+        wanted = [by_id[txid] for txid in response.json().get('transactions', []) if txid in by_id]
+        if wanted:
+            self.peers.request(node, 'POST', '/transactions/receive/bulk', **self._wire_bulk_body(wanted))
+
+    def announce_block(self, block: Block):
+        logger.info("Announcing block %d to other nodes.", block.index)
+        # Header first; peers that want the block get it as a compact block, off the request path
+        self.peers.relay(self.nodes, functools.partial(self._offer_block, block), f'block {block.index} announcement')
+
+    def _offer_block(self, block: Block, node):
+        response = self.peers.request(node, 'POST', '/inv', json={'blocks': [block.header_dict()]})
+        if response.status_code == 404:
+            self.peers.request(node, 'GET', '/nodes/resolve', timeout=30)
+            return
+        if block.hash not in response.json().get('blocks', []):
+            return
+        compact = self.compact_block(block)
+        result = self.peers.request(node, 'POST', '/blocks/compact', json=compact, timeout=30).json()
+        if result.get('status') == 'missing':
+            # One more round trip carrying just the transactions the peer could not find
+            missing = set(result.get('missing', []))
+            compact['prefilled'] += [[i, block.transactions[i].to_dict(include_signature=True)] for i in sorted(missing)]
+            result = self.peers.request(node, 'POST', '/blocks/compact', json=compact, timeout=30).json()
+        logger.debug("Compact block %d to %s: %s", block.index, node, result.get('status'))
+
+    def compact_block(self, block: Block):
+        # Reward transactions cannot be in anyone's pool, so they travel in full
+        return {
+            'header': block.header_dict(),
+            'short_ids': [short_transaction_id(block.hash, tx.transaction_id) for tx in block.transactions],
+            'prefilled': [[i, tx.to_dict(include_signature=True)] for i, tx in enumerate(block.transactions)
+                          if tx.sender == "Network"]
+        }
+
+    def has_block(self, header: Block):
+        snapshot = self.snapshot
+        return header.index < len(snapshot) and snapshot.chain[header.index].hash == header.hash
+
+    def wanted_inventory(self, transaction_ids, headers: List[Block]):
+        # Transactions we have neither pending nor confirmed, and announced blocks with valid
+        # proof-of-work that extend our tip; a longer chain elsewhere triggers a background sync
+        self._ensure_index()
+        wanted_transactions = [txid for txid in transaction_ids
+                               if txid not in self.mempool and self.index.locate(txid) is None]
+        wanted_blocks = []
+        snapshot = self.snapshot
+        for header in headers:
+            if self.has_block(header) or not header.has_valid_proof():
+                continue
+            if header.previous_hash == snapshot.tip.hash:
+                wanted_blocks.append(header.hash)
+            elif header.index >= len(snapshot):
+                self.request_sync()
+        return wanted_transactions, wanted_blocks
+
+    def receive_compact_block(self, header: Block, short_ids, prefilled):
+        if self.has_block(header):
+            return {'status': 'known'}
+        with self.lock:
+            tip = self.chain[-1]
+            if header.previous_hash != tip.hash:
+                if header.index > tip.index:
+                    self.request_sync()
+                    return {'status': 'syncing'}
+                return {'status': 'stale'}
+            if not validate_headers([header], tip, self.targets):
+                return {'status': 'invalid'}
+            # Match short ids against our own pool; ambiguous ids are treated as missing
+            candidates = {}
+            for tx in self.mempool:
+                sid = short_transaction_id(header.hash, tx.transaction_id)
+                candidates[sid] = None if sid in candidates else tx
+        transactions = []
+        missing = []
+        for i, sid in enumerate(short_ids):
+            tx = prefilled.get(i) or candidates.get(sid)
+            if tx is None:
+                missing.append(i)
+            transactions.append(tx)
+        if missing:
+            return {'status': 'missing', 'missing': missing}
+
+        block = Block(header.index, header.previous_hash, transactions, header.nonce, header.hash, header.timestamp)
+        if block.merkle_root != header.merkle_root:
+            # A short id matched the wrong transaction; ask for everything not prefilled
+            return {'status': 'missing', 'missing': [i for i in range(len(short_ids)) if i not in prefilled]}
+        if not validate_block_bodies([block])[0] or not self.add_block(block):
+            return {'status': 'invalid'}
+        self.announce_block(block)
+        return {'status': 'accepted'}
+
+    def request_sync(self):
+        # Coalesces sync requests from announcements into one background resolve at a time
+        with self._sync_lock:
+            if self._sync_running:
+                self._sync_again = True
+                return
+            self._sync_running = True
+        threading.Thread(target=self._sync_loop, name='chain-sync', daemon=True).start()
+
+    def _sync_loop(self):
+        while True:
+            try:
+                self.resolve_conflicts()
+            except Exception:
+                logger.exception("Background sync failed")
+            with self._sync_lock:
+                if not self._sync_again:
+                    self._sync_running = False
+                    return
+                self._sync_again = False
 
     def is_chain_valid(self):
-        for i in range(1, len(self.chain)):
-            current = self.chain[i]
-            previous = self.chain[i - 1]
-            if current.hash != current.calculate_hash():
+        # Headers serially, bodies in parallel batches, balances in one streaming replay
+        snapshot = self.snapshot
+        blocks = snapshot.blocks()
+        previous = next(blocks)
+        targets = TargetSchedule(lambda height: snapshot.chain[height])
+        balances = {}
+        seen = set()
+        for batch in batched(blocks, VALIDATION_BATCH_SIZE):
+            if not validate_headers(batch, previous, targets):
                 return False
-            if current.previous_hash != previous.hash:
+            if not all(validate_block_bodies(batch)):
                 return False
+            if not replay_balances(batch, balances, seen):
+                return False
+            previous = batch[-1]
         return True
 
     def register_node(self, address):
-        self.nodes.add(address)
+        # Replace rather than mutate so concurrent fan-outs iterate a stable set
+        self.nodes = self.nodes | {address}
+
+    def chain_work(self):
+        # (length, cumulative expected hashes) of our chain; fork choice follows work, not length
+        with self.lock:
+            return len(self.chain), self.targets.chain_work(len(self.chain))
 
     def resolve_conflicts(self):
-        longest_chain = None
-        max_length = len(self.chain)
+        best = None
+        _, max_work = self.chain_work()
+        locator = self.block_locator()
 
-        print("Starting resolve_conflicts: Checking with registered nodes for longer chain...")
+        logger.info("Starting resolve_conflicts: Checking with registered nodes for a chain with more work...")
 
-        for node in self.nodes:
-            try:
-                response = requests.get(f'http://{node}/chain', timeout=5)
-                if response.status_code == 200:
-                    length = response.json()['length']
-                    chain_data = response.json()['chain']
-                    
-                    if length > max_length:
-                        max_length = length
-                        longest_chain = chain_data
-                        print(f"New longer chain found at {node} with length {length}")
-            except requests.exceptions.RequestException as e:
-                print(f"Failed to fetch chain from {node}: {e}")
+        for node, response in self.peers.fan_out(self.nodes, 'POST', '/chain/locate', json={'locator': locator}).items():
+            if isinstance(response, Exception):
+                logger.warning("Failed to fetch chain from %s: %s", node, response)
+            elif response.status_code == 200:
+                # One malformed reply must not stop fork choice against the other peers
+                try:
+                    data = response.json()
+                    length, fork_height = data['length'], data['fork_height']
+                    # Peers that predate chain work are credited the minimum work their length allows
+                    work = data.get('work', length * expected_hashes(MAX_TARGET) if _is_integer(length) else None)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    logger.warning("Malformed chain summary from %s: %s", node, e)
+                    continue
+                if not (_is_integer(work) and _is_integer(length) and _is_integer(fork_height)):
+                    logger.warning("Malformed chain summary from %s", node)
+                    continue
+                if work > max_work and 0 <= fork_height < length:
+                    max_work = work
+                    best = (node, fork_height, length)
+                    logger.info("Chain with more work found at %s with length %d, forking at %d", node, length, fork_height)
 
-        if longest_chain:
-            # Rebuild wallet balances from the new chain
-            temp_wallet_balances = {}
-            new_chain = []
-            
-            for block_data in longest_chain:
-                block = Block(
-                    index=block_data['index'],
-                    previous_hash=block_data['previous_hash'],
-                    transactions=[Transaction.from_dict(tx) for tx in block_data['transactions']],
-                    nonce=block_data['nonce'],
-                    hash=block_data['current_hash']
-                )
-                new_chain.append(block)
-
-                # Replay all transactions to rebuild balances
-                for tx in block.transactions:
-                    if tx.sender != "Network":
-                        # Initialize sender balance to 0 if not exists
-                        if tx.sender not in temp_wallet_balances:
-                            temp_wallet_balances[tx.sender] = 0
-                        # Subtract amount from sender
-                        temp_wallet_balances[tx.sender] -= tx.amount
-                    
-                    # Initialize recipient balance to 0 if not exists
-                    if tx.recipient not in temp_wallet_balances:
-                        temp_wallet_balances[tx.recipient] = 0
-                    # Add amount to recipient
-                    temp_wallet_balances[tx.recipient] += tx.amount
-
-            # Update chain and wallet balances
-            self.chain = new_chain
-            self.wallet_balances = temp_wallet_balances
-
-            # Clean up pending transactions that are already in the new chain
-            chain_tx_ids = set()
-            for blk in self.chain:
-                for tx in blk.transactions:
-                    chain_tx_ids.add(tx.transaction_id)
-            self.pending_transactions = [tx for tx in self.pending_transactions if tx.transaction_id not in chain_tx_ids]
-
-            print("Chain replaced with the longer chain from network.")
-            return True
+        if best:
+            node, fork_height, length = best
+            try:
+                headers = self._fetch_headers(node, fork_height, length)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.warning("Failed to fetch headers from %s: %s", node, e)
+                headers = None
+            if headers and self._reorganize(node, fork_height, headers):
+                logger.info("Chain replaced with the chain with most work on the network: %d blocks after height %d.", len(headers), fork_height)
+                return True
 
-        print("Our chain is authoritative. No changes made.")
+        logger.info("Our chain is authoritative. No changes made.")
         return False
 
+    def _fetch_headers(self, node, fork_height, length):
+        # Headers first: check linkage and proof-of-work before downloading any block bodies
+        headers = []
+        # The branch's targets follow our chain up to the fork and the downloaded headers after it
+        targets = TargetSchedule(lambda height: self.chain[height] if height <= fork_height else headers[height - fork_height - 1],
+                                 self.targets.prefix(fork_height + 1))
+        while fork_height + 1 + len(headers) < length:
+            response = self.peers.request(node, 'GET', '/chain/headers',
+                                          params={'from_height': fork_height + 1 + len(headers), 'limit': HEADERS_PAGE_SIZE},
+                                          timeout=5)
+            page = [Block.from_dict(header, trust_merkle_root=True) for header in response.json()['headers']]
+            if not page:
+                break
+            # Appended before checking: a page can cross a retarget, and later targets depend on earlier headers
+            previous = headers[-1] if headers else self.chain[fork_height]
+            headers.extend(page)
+            if not validate_headers(page, previous, targets):
+                logger.warning("Invalid headers from %s", node)
+                return None
+        # The peer's claimed work decided the download; the headers themselves must back it up
+        if targets.chain_work(fork_height + 1 + len(headers)) <= self.chain_work()[1]:
+            logger.warning("Headers from %s carry less work than our chain", node)
+            return None
+        return headers
+
+    def _stream_blocks(self, node, from_height, count):
+        # Blocks arrive as length-prefixed binary frames or NDJSON and are decoded one at a time
+        response = self.peers.request(node, 'GET', '/chain/blocks',
+                                      params={'from_height': from_height, 'limit': count},
+                                      headers=self._wire_accept(NDJSON_MIMETYPE), stream=True, timeout=30)
+        with response:
+            if response.headers.get('Content-Type', '').startswith(BINARY_MIMETYPE):
+                for payload in read_frames(response.raw):
+                    yield Block.from_bytes(payload)
+            else:
+                for line in response.iter_lines():
+                    if line:
+                        yield Block.from_dict(json.loads(line))
+
+    def _download_branch(self, node, fork_height, headers):
+        # Runs without the writer lock: streams the branch a batch at a time, checks every block
+        # against its header and its body in parallel, and stops at the first bad block
+        checked = 0
+        try:
+            stream = itertools.islice(self._stream_blocks(node, fork_height + 1, len(headers)), len(headers))
+            for batch in batched(stream, VALIDATION_BATCH_SIZE):
+                good = []
+                for block, body_ok in zip(batch, validate_block_bodies(batch)):
+                    header = headers[checked]
+                    if block.hash != header.hash or block.merkle_root != header.merkle_root:
+                        logger.warning("Block %s from %s does not match its header", block.index, node)
+                        break
+                    if not body_ok:
+                        logger.warning("Block %s from %s has an invalid body", block.index, node)
+                        break
+                    good.append(block)
+                    checked += 1
+                if good:
+                    yield good
+                if len(good) < len(batch):
+                    return
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, IndexError, struct.error) as e:
+            logger.warning("Failed to fetch blocks from %s: %s", node, e)
+
+    def _reorganize(self, node, fork_height, headers):
+        if fork_height + 1 == len(self.snapshot):
+            return self._extend_chain(node, fork_height, headers)
+        # Our own blocks are only disconnected once the whole branch is downloaded and checked,
+        # so the writer lock is never held across a slow peer. The branch can be as long as the
+        # chain, so it is staged in a scratch block store rather than in memory
+        staging_dir = self.store.path if self.store is not None else None
+        with tempfile.TemporaryDirectory(prefix='branch-', dir=staging_dir) as path:
+            blocks = BlockStore(path, cache_size=VALIDATION_BATCH_SIZE, durable=False)
+            try:
+                for batch in self._download_branch(node, fork_height, headers):
+                    for block in batch:
+                        blocks.append(block)
+                if len(blocks) < len(headers):
+                    logger.warning("Remote branch from %s is incomplete, keeping our chain", node)
+                    return False
+                # Readers keep seeing the old snapshot until the whole branch switch is published
+                with self.lock:
+                    self._reorganizing = True
+                    try:
+                        return self._switch_branch(node, fork_height, blocks)
+                    finally:
+                        self._reorganizing = False
+                        self._template = None
+                        self._publish()
+            finally:
+                blocks.close()
+
+    def _extend_chain(self, node, fork_height, headers):
+        # The branch builds on our tip, so each checked batch is connected as it arrives and the
+        # lock is only taken per batch; a bad block keeps the valid prefix
+        for batch in self._download_branch(node, fork_height, headers):
+            with self.lock:
+                for block in batch:
+                    if not self.add_block(block):
+                        return False
+        if len(self.snapshot) < fork_height + 1 + len(headers):
+            return False
+        with self.lock:
+            self._save_snapshot()
+        return True
+
+    def _switch_branch(self, node, fork_height, blocks):
+        if fork_height >= len(self.chain) or self.chain[fork_height].hash != blocks[0].previous_hash:
+            logger.warning("Chain changed since the fork point was located, skipping sync with %s", node)
+            return False
+        disconnected = self._disconnect_to(fork_height)
+
+        confirmed = set()
+        switched = False
+        try:
+            for block in blocks:
+                if not self.add_block(block):
+                    break
+                confirmed.update(tx.transaction_id for tx in block.transactions)
+            switched = len(self.chain) == fork_height + 1 + len(blocks)
+        finally:
+            if not switched:
+                # Roll the partially applied branch back and restore our own blocks, whatever stopped it
+                logger.warning("Remote branch rejected at height %d, restoring our chain", len(self.chain))
+                self._disconnect_to(fork_height)
+                for block in reversed(disconnected):
+                    self.add_block(block)
+        if not switched:
+            return False
+
+        # Transactions from our abandoned blocks go back to the pending pool unless the new branch has them
+        for block in disconnected:
+            for tx in block.transactions:
+                if tx.sender != "Network" and tx.transaction_id not in confirmed:
+                    self._admit(tx)
+        self._save_snapshot()
+        return True
+
+MINING_JOBS_KEPT = 100
+
+class MiningJobs:
+    # Mining requests queued from the API and run one at a time on a background thread
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, miner_address):
+        with self._lock:
+            job = {'id': str(next(self._ids)), 'status': 'queued', 'address': miner_address,
+                   'submitted_at': time.time(), 'started_at': None, 'finished_at': None, 'block': None, 'error': None}
+            self.jobs[job['id']] = job
+            while len(self.jobs) > MINING_JOBS_KEPT:
+                oldest = next(iter(self.jobs.values()))
+                if oldest['status'] in ('queued', 'running'):
+                    break
+                self.jobs.popitem(last=False)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='mining-jobs', daemon=True)
+                self._worker.start()
+        self._queue.put(job['id'])
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list(self):
+        with self._lock:
+            return [dict(job) for job in reversed(self.jobs.values())]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            self._update(job_id, status='running', started_at=time.time())
+            try:
+                # Looked up per job so a node rebound in __main__ is the one that mines
+                block = blockchain.mine_pending_transactions(self.jobs[job_id]['address'])
+            except Exception as e:
+                logger.exception("Mining job %s failed", job_id)
+                self._update(job_id, status='failed', finished_at=time.time(), error=str(e))
+            else:
+                if block:
+                    blockchain.announce_block(block)
+                    self._update(job_id, status='done', finished_at=time.time(), block=block.to_dict(),
+                                 mining_stats=blockchain.last_mining_stats)
+                else:
+                    self._update(job_id, status='failed', finished_at=time.time(),
+                                 error='No transactions to mine or invalid transactions')
+            self._queue.task_done()
+
 blockchain = Blockchain()
+mining_jobs = MiningJobs()
+
+metrics.gauge('excoin_mempool_size', 'Transactions in the pending pool', lambda: len(blockchain.mempool))
+metrics.gauge('excoin_chain_height', 'Height of the chain tip', lambda: len(blockchain.snapshot) - 1)
+metrics.gauge('excoin_difficulty', 'Proof-of-work difficulty of the next block',
+              lambda: blockchain.mining_info()['difficulty'])
+metrics.gauge('excoin_broadcast_queue_size', 'Peer broadcasts waiting to be sent', lambda: blockchain.peers.queued())
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                     endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/mine', methods=['GET'])
 def mine_block():
@@ -339,39 +2636,47 @@ def mine_block():
     block = blockchain.mine_pending_transactions(miner_address)
     
     if block:
-        response = {
-            'message': 'Block mined',
-            'index': block.index,
-            'current_hash': block.hash,
-            'previous_hash': block.previous_hash,
-            'merkle_root': block.merkle_root,
-            'nonce': block.nonce,
-            'transactions': [tx.to_dict(include_signature=True) for tx in block.transactions]
-        }
-        
-        print("Mining successful, attempting broadcast to other nodes.")
-        
-        # Broadcast to trigger consensus in other nodes
-        for node in blockchain.nodes:
-            try:
-                print(f"Broadcasting to {node} to resolve conflicts...")
-                res = requests.get(f'http://{node}/nodes/resolve', timeout=5)
-                print(f"Response from {node}: {res.status_code} - {res.json()}")
-            except requests.exceptions.RequestException as e:
-                print(f"Could not resolve conflicts with node {node}: {e}")
+        response = {'message': 'Block mined', **block.to_dict(), 'mining_stats': blockchain.last_mining_stats}
+        blockchain.announce_block(block)
     else:
         response = {'message': 'No transactions to mine or invalid transactions'}
     return jsonify(response), 200
 
-@app.route('/transactions/add', methods=['POST'])
-def add_transaction():
-    values = request.get_json()
+@app.route('/mine/jobs', methods=['POST'])
+def submit_mining_job():
+    values = request.get_json(silent=True) or {}
+    miner_address = values.get('address') or request.args.get('address', 'default_miner')
+    job = mining_jobs.submit(miner_address)
+    return jsonify(job), 202
+
+@app.route('/mine/jobs', methods=['GET'])
+def list_mining_jobs():
+    return jsonify({'jobs': mining_jobs.list()}), 200
+
+@app.route('/mine/jobs/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    job = mining_jobs.get(job_id)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job), 200
+
+@app.route('/mining/info', methods=['GET'])
+def get_mining_info():
+    return jsonify(blockchain.mining_info()), 200
+
+def _well_formed_header(block: Block):
+    # Header field types a peer can get wrong; proof of work and linkage are checked on connect
+    return (_is_integer(block.index) and _is_integer(block.nonce) and is_number(block.timestamp)
+            and all(isinstance(value, str) for value in (block.hash, block.previous_hash, block.merkle_root)))
+
+def _signed_transaction(values):
+    # A client-submitted transaction with its signature, or None when fields are missing or mistyped
     required = [
         'sender', 'recipient', 'amount',
         'timestamp', 'nonce', 'transaction_id', 'chain_id', 'signature'
     ]
-    if not values or not all(k in values for k in required):
-        return 'Missing values', 400
+    if not isinstance(values, dict) or not all(k in values for k in required):
+        return None
 
     transaction = Transaction(
         sender=values['sender'],
@@ -381,47 +2686,287 @@ def add_transaction():
         timestamp=values['timestamp'],
         nonce=values['nonce'],
         transaction_id=values['transaction_id'],
-        chain_id=values['chain_id']
+        chain_id=values['chain_id'],
+        fee=values.get('fee', 0)
     )
+    return transaction if _well_formed(transaction) else None
+
+@app.route('/transactions/add', methods=['POST'])
+def add_transaction():
+    transaction = _signed_transaction(request.get_json())
+    if transaction is None:
+        return 'Missing or malformed values', 400
+
     if blockchain.add_transaction(transaction):
         response = {'message': 'Transaction will be added to Block'}
     else:
         response = {'message': 'Invalid transaction'}
     return jsonify(response), 201
 
+@app.route('/transactions/add/batch', methods=['POST'])
+def add_transactions_batch():
+    if _is_binary_request():
+        try:
+            items = [Transaction.from_bytes(payload) for payload in unpack_frames(request.get_data())]
+        except (ValueError, IndexError, struct.error):
+            return 'Malformed transactions', 400
+        items = [tx if _well_formed(tx) else None for tx in items]
+    else:
+        values = request.get_json(silent=True)
+        if not values or not isinstance(values.get('transactions'), list):
+            return 'Missing values', 400
+        items = [_signed_transaction(txd) for txd in values['transactions']]
+    if len(items) > TRANSACTION_BATCH_MAX:
+        return f'At most {TRANSACTION_BATCH_MAX} transactions per batch', 413
+
+    # Items with missing or mistyped fields are reported in place; the rest are admitted together
+    transactions = [tx for tx in items if tx is not None]
+    statuses = iter(blockchain.add_transactions(transactions))
+    results = [{'transaction_id': tx.transaction_id, 'status': next(statuses)} if tx is not None
+               else {'transaction_id': None, 'status': 'malformed'} for tx in items]
+    response = {
+        'results': results,
+        'accepted': sum(1 for result in results if result['status'] == 'accepted')
+    }
+    return jsonify(response), 200
+
+def _is_binary_request():
+    return request.mimetype == BINARY_MIMETYPE
+
+def _accepts_binary():
+    # Only an explicit Accept entry selects binary, so */* clients keep getting JSON
+    return any(mimetype == BINARY_MIMETYPE for mimetype, _ in request.accept_mimetypes)
+
 @app.route('/transactions/receive', methods=['POST'])
 def receive_transaction():
-    values = request.get_json()
-    if not values:
-        return 'Missing values', 400
-    tx = Transaction.from_dict(values)
+    if _is_binary_request():
+        try:
+            tx = Transaction.from_bytes(request.get_data())
+        except (ValueError, IndexError, struct.error):
+            return 'Malformed transaction', 400
+    else:
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict):
+            return 'Missing values', 400
+        tx = Transaction.from_dict(values)
+    if not _well_formed(tx):
+        return 'Malformed transaction', 400
     accepted = blockchain.receive_remote_transaction(tx)
     if accepted:
         return jsonify({'message': 'Transaction received and added to pending'}), 201
     else:
         return jsonify({'message': 'Transaction invalid or duplicate'}), 400
 
+@app.route('/transactions/receive/bulk', methods=['POST'])
+def receive_transactions_bulk():
+    if _is_binary_request():
+        try:
+            items = [Transaction.from_bytes(payload) for payload in unpack_frames(request.get_data())]
+        except (ValueError, IndexError, struct.error):
+            return 'Malformed transactions', 400
+    else:
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict) or not isinstance(values.get('transactions'), list):
+            return 'Missing values', 400
+        items = [Transaction.from_dict(txd) if isinstance(txd, dict) else None for txd in values['transactions']]
+    # Mistyped items are reported in place, like /transactions/add/batch does
+    items = [tx if tx is not None and _well_formed(tx) else None for tx in items]
+    statuses = iter(blockchain.receive_remote_transactions([tx for tx in items if tx is not None]))
+    results = [{'transaction_id': tx.transaction_id, 'status': next(statuses)} if tx is not None
+               else {'transaction_id': None, 'status': 'malformed'} for tx in items]
+    response = {
+        'results': results,
+        'accepted': sum(1 for result in results if result['status'] == 'accepted')
+    }
+    return jsonify(response), 200
+
+@app.route('/inv', methods=['POST'])
+def inventory():
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        return 'Missing values', 400
+    transaction_ids = values.get('transactions', [])
+    header_dicts = values.get('blocks', [])
+    if not isinstance(transaction_ids, list) or not all(isinstance(txid, str) for txid in transaction_ids):
+        return 'Malformed transaction ids', 400
+    if not isinstance(header_dicts, list) or not all(isinstance(header, dict) for header in header_dicts):
+        return 'Malformed block header', 400
+    try:
+        headers = [Block.from_dict(header, trust_merkle_root=True) for header in header_dicts]
+    except (KeyError, TypeError, AttributeError):
+        return 'Malformed block header', 400
+    if not all(_well_formed_header(header) for header in headers):
+        return 'Malformed block header', 400
+    wanted_transactions, wanted_blocks = blockchain.wanted_inventory(transaction_ids, headers)
+    return jsonify({'transactions': wanted_transactions, 'blocks': wanted_blocks}), 200
+
+@app.route('/blocks/compact', methods=['POST'])
+def receive_compact_block():
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or not isinstance(values.get('header'), dict) or not isinstance(values.get('short_ids'), list):
+        return 'Missing values', 400
+    entries = values.get('prefilled', [])
+    if (not all(isinstance(sid, str) for sid in values['short_ids']) or not isinstance(entries, list)
+            or not all(isinstance(entry, list) and len(entry) == 2 and _is_integer(entry[0]) and isinstance(entry[1], dict)
+                       for entry in entries)):
+        return 'Malformed compact block', 400
+    try:
+        header = Block.from_dict(values['header'], trust_merkle_root=True)
+        prefilled = {i: Transaction.from_dict(txd) for i, txd in entries}
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return 'Malformed compact block', 400
+    if not _well_formed_header(header) or not all(_well_formed(tx, unsigned=tx.sender == "Network") for tx in prefilled.values()):
+        return 'Malformed compact block', 400
+    result = blockchain.receive_compact_block(header, values['short_ids'], prefilled)
+    return jsonify(result), 200
+
+@app.route('/transactions/<transaction_id>', methods=['GET'])
+def get_transaction(transaction_id):
+    tx, block, position = blockchain.find_transaction(transaction_id)
+    if tx is not None:
+        response = {
+            'status': 'confirmed',
+            'transaction': tx.to_dict(include_signature=True),
+            'block_height': block.index,
+            'block_hash': block.hash,
+            'position': position,
+            'confirmations': len(blockchain.snapshot) - block.index
+        }
+        return jsonify(response), 200
+    tx = blockchain.mempool.get(transaction_id)
+    if tx is not None:
+        return jsonify({'status': 'pending', 'transaction': tx.to_dict(include_signature=True)}), 200
+    return jsonify({'message': 'Transaction not found'}), 404
+
 @app.route('/transactions/pending', methods=['GET'])
 def get_pending_transactions():
-    pending = [tx.to_dict(include_signature=True) for tx in blockchain.pending_transactions]
+    if _accepts_binary():
+        return Response(pack_frames(tx.to_bytes() for tx in blockchain.pending_transactions()), mimetype=BINARY_MIMETYPE)
+    pending = [tx.to_dict(include_signature=True) for tx in blockchain.pending_transactions()]
     return jsonify({'pending': pending}), 200
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def _wants_ndjson():
+    return request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+def _ndjson_response(blocks):
+    def generate():
+        for block in blocks:
+            yield json.dumps(block.to_dict()) + '\n'
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+def _chain_response(key, blocks, **fields):
+    # Streams {"<fields>": ..., "<key>": [block, ...]} without building the block list in memory
+    def generate():
+        yield '{' + ''.join(f'{json.dumps(k)}: {json.dumps(v)}, ' for k, v in fields.items()) + f'{json.dumps(key)}: ['
+        for i, block in enumerate(blocks):
+            yield (', ' if i else '') + json.dumps(block.to_dict())
+        yield ']}'
+    return Response(generate(), mimetype='application/json')
+
 @app.route('/chain', methods=['GET'])
 def full_chain():
-    chain_data = [{
-        'index': block.index,
-        'current_hash': block.hash,
-        'previous_hash': block.previous_hash,
-        'merkle_root': block.merkle_root,
-        'nonce': block.nonce,
-        'transactions': [tx.to_dict(include_signature=True) for tx in block.transactions]
-    } for block in blockchain.chain]
+    snapshot = blockchain.snapshot
+    length = len(snapshot)
+    from_height = max(request.args.get('from_height', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
+    stop = length if limit is None else from_height + max(limit, 0)
+    blocks = snapshot.blocks(from_height, stop)
+    if _wants_ndjson():
+        return _ndjson_response(blocks)
+    return _chain_response('chain', blocks, length=length, from_height=from_height)
+
+@app.route('/chain/locate', methods=['POST'])
+def locate_fork():
+    values = request.get_json()
+    if not values or not isinstance(values.get('locator'), list):
+        return 'Missing values', 400
+    snapshot = blockchain.snapshot
+    length, work = blockchain.chain_work()
+    response = {
+        'fork_height': snapshot.find_fork_point(values['locator']),
+        'length': length,
+        'work': work,
+        'tip_hash': snapshot.tip.hash
+    }
+    return jsonify(response), 200
+
+def _requested_range(max_limit):
+    from_height = request.args.get('from_height', 0, type=int)
+    limit = min(request.args.get('limit', max_limit, type=int), max_limit)
+    return max(from_height, 0), max(limit, 0)
+
+@app.route('/chain/headers', methods=['GET'])
+def chain_headers():
+    snapshot = blockchain.snapshot
+    from_height, limit = _requested_range(HEADERS_PAGE_SIZE)
+    headers = [block.header_dict() for block in snapshot.blocks(from_height, from_height + limit)]
+    return jsonify({'headers': headers, 'length': len(snapshot)}), 200
+
+@app.route('/chain/blocks', methods=['GET'])
+def chain_blocks():
+    snapshot = blockchain.snapshot
+    if _accepts_binary() or _wants_ndjson():
+        # Streamed responses are not held in memory, so they may cover the whole requested range
+        from_height = max(request.args.get('from_height', 0, type=int), 0)
+        limit = request.args.get('limit', len(snapshot), type=int)
+        blocks = snapshot.blocks(from_height, from_height + max(limit, 0))
+        if _accepts_binary():
+            return Response((pack_frames([block.to_bytes()]) for block in blocks), mimetype=BINARY_MIMETYPE)
+        return _ndjson_response(blocks)
+    from_height, limit = _requested_range(BLOCKS_PAGE_SIZE)
+    blocks = [block.to_dict() for block in snapshot.blocks(from_height, from_height + limit)]
+    return jsonify({'blocks': blocks, 'length': len(snapshot)}), 200
+
+@app.route('/merkle/proof', methods=['GET'])
+def merkle_proof():
+    height = request.args.get('height', type=int)
+    transaction_id = request.args.get('transaction_id')
+    if height is None or not transaction_id:
+        return jsonify({'message': 'Missing height or transaction_id'}), 400
+    snapshot = blockchain.snapshot
+    if not 0 <= height < len(snapshot):
+        return jsonify({'message': 'Block not found'}), 404
+    block = snapshot.chain[height]
+    index, proof = block.merkle_proof(transaction_id)
+    if proof is None:
+        return jsonify({'message': 'Transaction not in block'}), 404
     response = {
-        'chain': chain_data,
-        'length': len(chain_data)
+        'block_height': height,
+        'block_hash': block.hash,
+        'merkle_root': block.merkle_root,
+        'transaction_id': transaction_id,
+        'transaction_hash': block.transactions[index].digest().hex(),
+        'index': index,
+        'proof': proof
     }
     return jsonify(response), 200
 
+@app.route('/merkle/verify', methods=['POST'])
+def merkle_verify():
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or 'proof' not in values or 'merkle_root' not in values:
+        return 'Missing values', 400
+    if not isinstance(values['proof'], list) or not isinstance(values['merkle_root'], str):
+        return 'Malformed proof', 400
+    if 'transaction' in values:
+        if not isinstance(values['transaction'], dict):
+            return 'Malformed transaction', 400
+        transaction = Transaction.from_dict(values['transaction'])
+        # The leaf is the unsigned payload, so proofs work for reward transactions too
+        if not _well_formed(transaction, unsigned=True):
+            return 'Malformed transaction', 400
+        leaf = transaction.digest().hex()
+    elif 'transaction_hash' in values:
+        leaf = values['transaction_hash']
+        if not isinstance(leaf, str):
+            return 'Malformed transaction_hash', 400
+    else:
+        return 'Missing transaction or transaction_hash', 400
+    valid = MerkleTree.verify_proof(leaf, values['proof'], values['merkle_root'])
+    return jsonify({'valid': valid, 'transaction_hash': leaf}), 200
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
     values = request.get_json()
@@ -436,34 +2981,17 @@ def register_nodes():
     }
     return jsonify(response), 201
 
+@app.route('/nodes/stats', methods=['GET'])
+def node_stats():
+    return jsonify(blockchain.peers.to_dict()), 200
+
 @app.route('/nodes/resolve', methods=['GET'])
 def consensus():
     replaced = blockchain.resolve_conflicts()
+    blocks = blockchain.snapshot.blocks()
     if replaced:
-        response = {
-            'message': 'Our chain was replaced',
-            'new_chain': [{
-                'index': block.index,
-                'current_hash': block.hash,
-                'previous_hash': block.previous_hash,
-                'merkle_root': block.merkle_root,
-                'nonce': block.nonce,
-                'transactions': [tx.to_dict(include_signature=True) for tx in block.transactions]
-            } for block in blockchain.chain]
-        }
-    else:
-        response = {
-            'message': 'Our chain is authoritative',
-            'chain': [{
-                'index': block.index,
-                'current_hash': block.hash,
-                'previous_hash': block.previous_hash,
-                'merkle_root': block.merkle_root,
-                'nonce': block.nonce,
-                'transactions': [tx.to_dict(include_signature=True) for tx in block.transactions]
-            } for block in blockchain.chain]
-        }
-    return jsonify(response), 200
+        return _chain_response('new_chain', blocks, message='Our chain was replaced')
+    return _chain_response('chain', blocks, message='Our chain is authoritative')
 
 @app.route('/wallet/create', methods=['GET'])
 def create_wallet():
@@ -472,7 +3000,7 @@ def create_wallet():
     public_key_hex = public_key.to_string().hex()
 
     # Initialize wallet with 0 balance
-    blockchain.wallet_balances[public_key_hex] = 0
+    blockchain.ensure_wallet(public_key_hex)
 
     response = {
         'private_key': private_key.to_string().hex(),
@@ -492,6 +3020,11 @@ def sign_transaction():
     private_key_hex = values['private_key']
     recipient = values['recipient']
     amount = values['amount']
+    fee = values.get('fee', 0)
+    if not is_number(amount) or amount <= 0:
+        return 'Invalid amount', 400
+    if not is_number(fee) or fee < 0:
+        return 'Invalid fee', 400
     
     # Get private and public keys from sender
     private_key = SigningKey.from_string(bytes.fromhex(private_key_hex), curve=SECP256k1)
@@ -501,12 +3034,12 @@ def sign_transaction():
     transaction = Transaction(
         sender=public_key,
         recipient=recipient,
-        amount=amount
+        amount=amount,
+        fee=fee
     )
 
     # Sign the transaction
-    transaction_data = json.dumps(transaction.to_dict(), sort_keys=True)
-    signature = private_key.sign(transaction_data.encode()).hex()
+    signature = private_key.sign(transaction.signing_message().encode()).hex()
     
     # Return transaction data and signature
     response = {
@@ -515,6 +3048,44 @@ def sign_transaction():
     }
     return jsonify(response), 200
 
+@app.route('/transaction/sign/batch', methods=['POST'])
+def sign_transactions_batch():
+    values = request.get_json(silent=True)
+    if not values or 'private_key' not in values or not isinstance(values.get('transactions'), list):
+        return 'Missing values', 400
+    if len(values['transactions']) > TRANSACTION_BATCH_MAX:
+        return f'At most {TRANSACTION_BATCH_MAX} transactions per batch', 413
+
+    # Parse the key once for the whole batch
+    try:
+        private_key = SigningKey.from_string(bytes.fromhex(values['private_key']), curve=SECP256k1)
+    except (ValueError, TypeError, AssertionError):
+        return 'Invalid private key', 400
+    public_key = private_key.get_verifying_key().to_string().hex()
+
+    results = []
+    for item in values['transactions']:
+        if not isinstance(item, dict) or not all(k in item for k in ('recipient', 'amount')):
+            results.append({'error': 'Missing values'})
+            continue
+        if not isinstance(item['recipient'], str) or not is_number(item['amount']) or item['amount'] <= 0:
+            results.append({'error': 'Invalid recipient or amount'})
+            continue
+        if not is_number(item.get('fee', 0)) or item.get('fee', 0) < 0:
+            results.append({'error': 'Invalid fee'})
+            continue
+        transaction = Transaction(
+            sender=public_key,
+            recipient=item['recipient'],
+            amount=item['amount'],
+            fee=item.get('fee', 0)
+        )
+        results.append({
+            "transaction": transaction.to_dict(),
+            "signature": private_key.sign(transaction.signing_message().encode()).hex()
+        })
+    return jsonify({'results': results}), 200
+
 @app.route('/wallet/balance', methods=['GET'])
 def get_balance():
     public_key = request.args.get('public_key')
@@ -522,18 +3093,76 @@ def get_balance():
         return jsonify({'message': 'Missing public key'}), 400
     
     # Get balance (0 if wallet doesn't exist)
-    balance = blockchain.wallet_balances.get(public_key, 0)
+    balances = blockchain.snapshot.balances
+    balance = balances.get(public_key, 0)
     
     response = {
         'public_key': public_key,
-        'balance': balance
+        'balance': balance,
+        'available': blockchain.available_balance(public_key, balances),
+        'pending_count': blockchain.mempool.pending_count(public_key)
     }
     return jsonify(response), 200
 
+@app.route('/wallet/history', methods=['GET'])
+def get_history():
+    public_key = request.args.get('public_key')
+    if not public_key:
+        return jsonify({'message': 'Missing public key'}), 400
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 0), 500)
+
+    total, entries = blockchain.address_history(public_key, offset, limit)
+    transactions = []
+    for block, position in entries:
+        tx = block.transactions[position]
+        transactions.append({
+            **tx.to_dict(include_signature=True),
+            'direction': 'sent' if tx.sender == public_key else 'received',
+            'block_height': block.index,
+            'position': position
+        })
+    response = {
+        'public_key': public_key,
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'transactions': transactions
+    }
+    return jsonify(response), 200
+
+ASGI_BACKLOG = 4096
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('--data-dir', default=None, help='directory for the persistent block store')
+    parser.add_argument('--prune-keep', default=None, type=int, help='with --data-dir, keep only this many recent blocks in memory')
+    parser.add_argument('--checkpoint-interval', default=SNAPSHOT_INTERVAL, type=int, help='with --data-dir, blocks between balance checkpoints')
+    parser.add_argument('--wire-format', default='binary', choices=['binary', 'json'], help='encoding used for peer traffic')
+    parser.add_argument('--block-max-bytes', default=BLOCK_MAX_BYTES, type=int, help='size limit for mined blocks, in encoded transaction bytes')
+    parser.add_argument('--block-max-txs', default=BLOCK_MAX_TRANSACTIONS, type=int, help='transaction limit for mined blocks')
+    parser.add_argument('--server', default='flask', choices=['flask', 'asgi'], help='threaded Flask server or uvicorn event-loop server (needs uvicorn)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='node log level')
     args = parser.parse_args()
+    if args.prune_keep is not None and not args.data_dir:
+        parser.error('--prune-keep needs --data-dir to page older blocks out to')
     port = args.port
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    configure_logging(args.log_level)
+    if args.data_dir:
+        import atexit
+        blockchain = Blockchain(data_dir=args.data_dir, prune_keep=args.prune_keep, checkpoint_interval=args.checkpoint_interval)
+        atexit.register(blockchain.close)
+    blockchain.wire_format = args.wire_format
+    blockchain.block_max_bytes = args.block_max_bytes
+    blockchain.block_max_transactions = args.block_max_txs
+    if args.server == 'asgi':
+        # uvicorn holds the connections on its event loop and runs the Flask app on worker threads
+        try:
+            import uvicorn
+        except ImportError:
+            parser.error('--server asgi needs uvicorn: pip install uvicorn')
+        uvicorn.run(app, interface='wsgi', host='0.0.0.0', port=port, backlog=ASGI_BACKLOG, log_level=args.log_level.lower())
+    else:
+        app.run(host='0.0.0.0', port=port, threaded=True)
\ No newline at end of file
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import time
+
+import pytest
+
+import blockchain as bc
+
+
+def baseline_merkle_root(transactions):
+    # The original hex-string algorithm; roots already on chain were built with it
+    if not transactions:
+        return ''
+    hashes = [hashlib.sha256(json.dumps(tx.to_dict(), sort_keys=True).encode()).hexdigest() for tx in transactions]
+    while len(hashes) > 1:
+        if len(hashes) % 2 == 1:
+            hashes.append(hashes[-1])
+        hashes = [hashlib.sha256((hashes[i] + hashes[i + 1]).encode()).hexdigest() for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+
+def signed_transfer(wallet, recipient, amount, fee=0, timestamp=None):
+    tx = bc.Transaction(wallet.get_public_key(), recipient, amount, fee=fee, timestamp=timestamp)
+    tx.signature = wallet.sign_transaction(tx.signing_message())
+    return tx
+
+
+def mined_block(previous, transactions, timestamp=None):
+    block = bc.Block(previous.index + 1, previous.hash, transactions,
+                     timestamp=previous.timestamp + 1 if timestamp is None else timestamp)
+    block.mine_block(workers=1)
+    return block
+
+
+def reward(miner, amount=bc.BLOCK_REWARD):
+    return bc.Transaction("Network", miner, amount)
+
+
+class Stamped:
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+
+@pytest.fixture
+def node():
+    chain = bc.Blockchain()
+    yield chain
+    chain.close()
+
+
+def test_transaction_round_trips_through_binary_codec():
+    wallet = bc.Wallet()
+    for tx in (signed_transfer(wallet, 'bob', 5), signed_transfer(wallet, 'bob', 2.5, fee=0.25), reward('miner')):
+        decoded = bc.Transaction.from_bytes(tx.to_bytes())
+        assert decoded.to_dict(include_signature=True) == tx.to_dict(include_signature=True)
+        assert decoded.digest() == tx.digest()
+
+
+def test_transaction_without_trailing_fee_field_decodes_as_fee_free():
+    tx = signed_transfer(bc.Wallet(), 'bob', 5)
+    payload = bytes(bc._pack_fields(tx.to_dict(include_signature=True), bc.Transaction.BINARY_FIELDS[:-1]))
+    assert bc.Transaction.from_bytes(payload).fee == 0
+
+
+def test_codec_keeps_value_types():
+    values = {'hex': 'ab' * 32, 'text': 'alice', 'odd_hex': 'abc', 'int': -7, 'float': 1.5, 'big': 2 ** 80, 'none': None}
+    decoded, _ = bc._unpack_fields(bytes(bc._pack_fields(values, list(values))), list(values))
+    assert decoded == values
+    assert type(decoded['float']) is float and type(decoded['big']) is int
+
+
+def test_block_round_trips_through_binary_codec(node):
+    wallet = bc.Wallet()
+    block = mined_block(node.chain[0], [signed_transfer(wallet, 'bob', 1, fee=0.5), reward('miner', bc.BLOCK_REWARD + 0.5)])
+    decoded = bc.Block.from_bytes(block.to_bytes())
+    assert decoded.to_dict() == block.to_dict()
+    assert decoded.calculate_hash() == block.hash
+
+
+def test_frames_round_trip():
+    payloads = [b'', b'a', b'\x00' * 1000]
+    assert [bytes(p) for p in bc.unpack_frames(bc.pack_frames(payloads))] == payloads
+
+
+@pytest.mark.parametrize('count', range(0, 10))
+def test_merkle_root_matches_baseline_algorithm(count):
+    wallet = bc.Wallet()
+    transactions = [signed_transfer(wallet, f'r{i}', i + 1, timestamp=1700000000 + i) for i in range(count)]
+    assert bc.calculate_merkle_root(transactions) == baseline_merkle_root(transactions)
+
+
+def test_incremental_merkle_tree_and_proofs_match_full_build():
+    wallet = bc.Wallet()
+    transactions = [signed_transfer(wallet, f'r{i}', 1, timestamp=1700000000 + i) for i in range(7)]
+    tree = bc.MerkleTree()
+    for count, tx in enumerate(transactions, start=1):
+        tree.append(tx.digest())
+        assert tree.root() == baseline_merkle_root(transactions[:count])
+    for index, tx in enumerate(transactions):
+        assert bc.MerkleTree.verify_proof(tx.digest().hex(), tree.proof(index), tree.root())
+
+
+def test_retarget_tightens_fast_epochs_by_at_most_the_cap():
+    # Blocks one second apart instead of TARGET_BLOCK_SECONDS
+    schedule = bc.TargetSchedule(lambda height: Stamped(1700000000 + height))
+    assert schedule.target_for(bc.RETARGET_INTERVAL - 1) == bc.MAX_TARGET
+    assert schedule.target_for(bc.RETARGET_INTERVAL) == bc.MAX_TARGET // bc.MAX_RETARGET_FACTOR
+
+
+def test_retarget_never_eases_past_the_minimum_target():
+    schedule = bc.TargetSchedule(lambda height: Stamped(1700000000 + height * bc.TARGET_BLOCK_SECONDS * 100))
+    assert schedule.target_for(bc.RETARGET_INTERVAL * 3) == bc.MAX_TARGET
+
+
+def test_chain_work_adds_up_per_epoch():
+    schedule = bc.TargetSchedule(lambda height: Stamped(1700000000 + height))
+    first, second = bc.expected_hashes(bc.MAX_TARGET), bc.expected_hashes(bc.MAX_TARGET // bc.MAX_RETARGET_FACTOR)
+    assert schedule.chain_work(bc.RETARGET_INTERVAL + 3) == bc.RETARGET_INTERVAL * first + 3 * second
+
+
+def test_headers_must_be_stamped_after_median_time_past(node):
+    for _ in range(3):
+        node.mine_pending_transactions('miner')
+    tip = node.chain[-1]
+    median = node.targets.median_time_past(tip.index + 1)
+    assert not bc.validate_headers([mined_block(tip, [reward('miner')], timestamp=median)], tip, node.targets)
+    assert bc.validate_headers([mined_block(tip, [reward('miner')], timestamp=time.time())], tip, node.targets)
+
+
+def test_headers_must_meet_the_scheduled_target(node):
+    tip = node.chain[-1]
+    block = mined_block(tip, [reward('miner')], timestamp=time.time())
+    assert bc.validate_headers([block], tip, node.targets)
+    harder = bc.TargetSchedule(node.targets.block_at, targets=[1])
+    assert not bc.validate_headers([block], tip, harder)
+
+
+def test_reward_check_accepts_subsidy_plus_fees():
+    wallet = bc.Wallet()
+    transfers = [signed_transfer(wallet, 'bob', 1, fee=0.5), signed_transfer(wallet, 'bob', 1, fee=0.25)]
+    block = bc.Block(1, '0', transfers + [reward('miner', bc.BLOCK_REWARD + 0.75)])
+    assert bc.check_block_transactions(block)
+
+
+@pytest.mark.parametrize('transactions', [
+    lambda transfer: [transfer, reward('miner', bc.BLOCK_REWARD)],
+    lambda transfer: [transfer, reward('miner', bc.BLOCK_REWARD + 10)],
+    lambda transfer: [reward('miner', bc.BLOCK_REWARD + 0.5), transfer],
+    lambda transfer: [reward('miner'), transfer, reward('miner', bc.BLOCK_REWARD + 0.5)],
+    lambda transfer: [transfer],
+    lambda transfer: [],
+], ids=['fees-unclaimed', 'overpaid', 'reward-first', 'two-rewards', 'no-reward', 'empty'])
+def test_reward_check_rejects_wrong_rewards(transactions):
+    transfer = signed_transfer(bc.Wallet(), 'bob', 1, fee=0.5)
+    assert not bc.check_block_transactions(bc.Block(1, '0', transactions(transfer)))
+
+
+@pytest.mark.parametrize('amount, fee', [(0, 0), (-1, 0), (1, -0.5), ('1', 0)])
+def test_reward_check_rejects_bad_amounts_and_fees(amount, fee):
+    transfer = signed_transfer(bc.Wallet(), 'bob', amount, fee=fee)
+    assert not bc.check_block_transactions(bc.Block(1, '0', [transfer, reward('miner')]))
+
+
+def test_reorg_switches_to_heavier_branch():
+    ours, theirs = bc.Blockchain(), bc.Blockchain()
+    for _ in range(3):
+        ours.mine_pending_transactions('alice')
+    for _ in range(5):
+        theirs.mine_pending_transactions('bob')
+    assert ours._switch_branch('peer', 0, theirs.chain[1:])
+    assert [block.hash for block in ours.chain] == [block.hash for block in theirs.chain]
+    assert ours.wallet_balances.get('alice') is None
+    assert ours.wallet_balances['bob'] == 5 * bc.BLOCK_REWARD
+    assert ours.is_chain_valid()
+
+
+def test_reorg_rolls_back_and_restores_our_chain_when_branch_is_rejected():
+    ours, theirs = bc.Blockchain(), bc.Blockchain()
+    wallet = bc.Wallet()
+    ours.mine_pending_transactions(wallet.get_public_key())
+    assert ours.add_transaction(signed_transfer(wallet, 'carol', 10, fee=1))
+    for _ in range(2):
+        ours.mine_pending_transactions('alice')
+    for _ in range(4):
+        theirs.mine_pending_transactions('bob')
+    # The branch's last block overpays its reward, so it is only rejected once connected
+    branch = theirs.chain[1:] + [mined_block(theirs.chain[-1], [reward('bob', bc.BLOCK_REWARD + 1)])]
+    hashes = [block.hash for block in ours.chain]
+    balances = dict(ours.wallet_balances)
+
+    assert not ours._switch_branch('peer', 0, branch)
+    assert [block.hash for block in ours.chain] == hashes
+    assert dict(ours.wallet_balances) == balances
+    assert ours.wallet_balances['carol'] == 10
+    assert ours.is_chain_valid()
+
+
+def test_balances_are_copy_on_write():
+    published = bc.Balances({'alice': 5})
+    writable = published.derive()
+    writable['alice'] = 3
+    writable['bob'] = 2
+    del writable['alice']
+    assert dict(published) == {'alice': 5}
+    assert dict(writable) == {'bob': 2}
+    assert 'alice' not in writable